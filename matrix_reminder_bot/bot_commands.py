@@ -1,28 +1,133 @@
 import logging
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
-import arrow
-import dateparser
 import pytz
-from apscheduler.job import Job
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from nio import AsyncClient, MatrixRoom
 from nio.events.room_events import RoomMessageText
-from pretty_cron import prettify_cron
-from readabledelta import readabledelta
 
 from matrix_reminder_bot.config import CONFIG
-from matrix_reminder_bot.errors import CommandError, CommandSyntaxError
+from matrix_reminder_bot.errors import (
+    CommandError,
+    CommandSyntaxError,
+    WorkerPoolFullError,
+)
 from matrix_reminder_bot.functions import command_syntax, send_text_to_room
-from matrix_reminder_bot.reminder import ALARMS, REMINDERS, SCHEDULER, Reminder
+from matrix_reminder_bot.reminder import ALARMS, REMINDERS, Reminder, SpreadTrigger
 from matrix_reminder_bot.storage import Storage
+from matrix_reminder_bot.time_parsing import (
+    PARSE_CACHE_LOOKUPS,
+    parse_cached,
+    parse_fast,
+    parse_interval,
+    parser_options,
+)
+from matrix_reminder_bot.workers import WORKERS
 
 logger = logging.getLogger(__name__)
 
 
+def _format_reminder_lines(
+    reminders: List[
+        Tuple[
+            str,
+            bool,
+            Optional[str],
+            Optional[timedelta],
+            Optional[timedelta],
+            datetime,
+            str,
+        ]
+    ]
+) -> Tuple[List[str], List[str], List[str]]:
+    """Describes reminders for the reminder list, grouped by kind
+
+    This is run in a worker, so it takes plain values rather than Reminders.
+
+    Args:
+        reminders: For each reminder, a tuple of its kind ("cron", "one-shot" or
+            "interval"), whether it is an alarm, its cron tab, how often it repeats,
+            how far it's spread out from its scheduled times, when it next fires and
+            its text
+
+    Returns:
+        Markdown list items for the one-time, cron and repeating reminders
+    """
+    # These take a while to import, so only do so once they're needed
+    import arrow
+    from pretty_cron import prettify_cron
+    from readabledelta import readabledelta
+
+    cron_reminder_lines = []
+    one_shot_reminder_lines = []
+    interval_reminder_lines = []
+
+    for (
+        kind,
+        alarm,
+        cron_tab,
+        recurse_timedelta,
+        spread,
+        next_fire_time,
+        text,
+    ) in reminders:
+        # Organise alarms into markdown lists
+        line = "- "
+        if alarm:
+            # Note that an alarm exists if available
+            alarm_clock_emoji = "⏰"
+            line += alarm_clock_emoji + " "
+
+        # Print the duration before (next) execution
+        next_execution = arrow.get(next_fire_time)
+
+        # Note how long after its scheduled times a spread out reminder goes off
+        spread_note = f", +{int(spread.total_seconds())}s" if spread else ""
+
+        # Cron-based reminders
+        if kind == "cron":
+            # A human-readable cron tab, in addition to the actual tab
+            line += f"{prettify_cron(cron_tab)} (`{cron_tab}`{spread_note}); next run {next_execution.humanize()}"
+
+        # One-time reminders
+        elif kind == "one-shot":
+            # Just print when the reminder will go off
+            line += f"{next_execution.humanize()}"
+
+        # Repeat reminders
+        elif kind == "interval":
+            # Print the interval, and when it will next go off
+            line += f"every {readabledelta(recurse_timedelta)}{spread_note}; next run {next_execution.humanize()}"
+
+        # Add the reminder's text
+        line += f'; *"{text}"*'
+
+        # Output the status of each reminder. We divide up the reminders by type in order
+        # to show them in separate sections, and display them differently
+        if kind == "cron":
+            cron_reminder_lines.append(line)
+        elif kind == "one-shot":
+            one_shot_reminder_lines.append(line)
+        elif kind == "interval":
+            interval_reminder_lines.append(line)
+
+    return one_shot_reminder_lines, cron_reminder_lines, interval_reminder_lines
+
+
+def _describe_interval(interval: timedelta) -> str:
+    """Describes how often a reminder repeats, such as "1 day, 2 hours"
+
+    This is run in a worker.
+    """
+    # This takes a while to import, so only do so once it's needed
+    from readabledelta import readabledelta
+
+    return readabledelta(interval)
+
+
 class Command(object):
     def __init__(
         self,
@@ -80,7 +185,9 @@ class Command(object):
 
         return cron_tab, reminder_text.strip()
 
-    def _parse_reminder_command_args(self) -> Tuple[datetime, str, Optional[timedelta]]:
+    async def _parse_reminder_command_args(
+        self,
+    ) -> Tuple[datetime, str, Optional[timedelta]]:
         """Processes the list of arguments and returns parsed reminder information
 
         Returns:
@@ -114,14 +221,17 @@ class Command(object):
             recurse_time_str = time_str[len("every") :].strip()
             logger.debug("Got recurring time: %s", recurse_time_str)
 
-            # Convert the recurse time to a datetime object
-            recurse_time = self._parse_str_to_time(recurse_time_str)
+            # Simple intervals such as "1 week" can be read directly
+            recurse_timedelta = parse_interval(recurse_time_str)
+            if recurse_timedelta is None:
+                # Convert the recurse time to a datetime object
+                recurse_time = await self._parse_str_to_time(recurse_time_str)
 
-            # Generate a timedelta between now and the recurring time
-            # `recurse_time` is guaranteed to always be in the future
-            current_time = self._get_datetime_now(CONFIG.timezone)
+                # Generate a timedelta between now and the recurring time
+                # `recurse_time` is guaranteed to always be in the future
+                current_time = self._get_datetime_now(CONFIG.timezone)
 
-            recurse_timedelta = recurse_time - current_time
+                recurse_timedelta = recurse_time - current_time
             logger.debug("Recurring timedelta: %s", recurse_timedelta)
 
             # Extract the start time
@@ -134,11 +244,13 @@ class Command(object):
             logger.debug("Start time: %s", time_str)
 
         # Convert start time string to a datetime object
-        time = self._parse_str_to_time(time_str, tz_aware=False)
+        time = await self._parse_str_to_time(time_str, tz_aware=False)
 
         return time, reminder_text, recurse_timedelta
 
-    def _parse_str_to_time(self, time_str: str, tz_aware: bool = True) -> datetime:
+    async def _parse_str_to_time(
+        self, time_str: str, tz_aware: bool = True
+    ) -> datetime:
         """Converts a human-readable, future time string to a datetime object
 
         Args:
@@ -152,19 +264,20 @@ class Command(object):
         Raises:
             CommandError: if conversion was not successful, or time is in the past.
         """
-        time = dateparser.parse(
-            time_str,
-            settings={
-                "PREFER_DATES_FROM": "future",
-                "TIMEZONE": CONFIG.timezone,
-                "RETURN_AS_TIMEZONE_AWARE": tz_aware,
-            },
-        )
+        # Common forms of time are quick to parse, so only hand off to a worker if
+        # dateparser is needed
+        tzinfo = pytz.timezone(CONFIG.timezone)
+        time = parse_fast(time_str, tzinfo, tz_aware, datetime.now(tzinfo))
+        if time is None:
+            # The fast path has already been tried, so go straight to dateparser
+            time, cache_hit = await WORKERS.run(
+                parse_cached, time_str, CONFIG.timezone, tz_aware, parser_options()
+            )
+            PARSE_CACHE_LOOKUPS.inc("hit" if cache_hit else "miss")
         if not time:
             raise CommandError(f"The given time '{time_str}' is invalid.")
 
         # Disallow times in the past
-        tzinfo = pytz.timezone(CONFIG.timezone)
         if time.replace(tzinfo=tzinfo) < self._get_datetime_now(CONFIG.timezone):
             raise CommandError(f"The given time '{time_str}' is in the past.")
 
@@ -193,11 +306,20 @@ class Command(object):
         Args:
             reminder: The Reminder to confirm
         """
+        # Let the user know that the reminder won't go off exactly on time
+        spread_text = ""
+        if reminder.spread:
+            spread_text = (
+                f"\n\nTo avoid busy times, this reminder will go off "
+                f"{int(reminder.spread.total_seconds())} seconds after each time it's "
+                f"scheduled for."
+            )
+
         if reminder.cron_tab:
             # Special-case cron-style reminders. We currently don't do any special
             # parsing for them
             await send_text_to_room(
-                self.client, self.room.room_id, "OK, I will remind you!"
+                self.client, self.room.room_id, "OK, I will remind you!" + spread_text
             )
 
             return
@@ -215,11 +337,20 @@ class Command(object):
         text = f"OK, I will remind {target} on {human_readable_start_time}"
 
         if reminder.recurse_timedelta:
-            # Inform the user how often their reminder will repeat
-            text += f", and again every {readabledelta(reminder.recurse_timedelta)}"
+            # Inform the user how often their reminder will repeat. The reminder has
+            # already been set, so if the workers are busy, describe it here rather
+            # than failing the command
+            try:
+                interval = await WORKERS.run(
+                    _describe_interval, reminder.recurse_timedelta
+                )
+            except WorkerPoolFullError:
+                interval = _describe_interval(reminder.recurse_timedelta)
+            text += f", and again every {interval}"
 
         # Add some punctuation
         text += "!"
+        text += spread_text
 
         if reminder.alarm:
             # Inform the user that an alarm is attached to this reminder
@@ -261,7 +392,7 @@ class Command(object):
                 start_time,
                 reminder_text,
                 recurse_timedelta,
-            ) = self._parse_reminder_command_args()
+            ) = await self._parse_reminder_command_args()
 
             logger.debug(
                 "Creating reminder in room %s with delta %s: %s",
@@ -280,8 +411,6 @@ class Command(object):
 
         # Create the reminder
         reminder = Reminder(
-            self.client,
-            self.store,
             self.room.room_id,
             reminder_text,
             start_time=start_time,
@@ -293,8 +422,8 @@ class Command(object):
         )
 
         # Record the reminder
-        REMINDERS[(self.room.room_id, reminder_text.upper())] = reminder
-        self.store.store_reminder(reminder)
+        REMINDERS[reminder.key] = reminder
+        await self.store.store_reminder(reminder)
 
         # Send a message to the room confirming the creation of the reminder
         await self._confirm_reminder(reminder)
@@ -358,16 +487,12 @@ class Command(object):
     @command_syntax("[<reminder text>]")
     async def _silence(self):
         """Silences an ongoing alarm"""
-        alarm_job = None
-
         # Attempt to find a reminder with an alarm currently going off
         reminder_text = " ".join(self.args)
         if reminder_text:
-            # Find the alarm job via its reminder text
-            alarm_job = ALARMS.get((self.room.room_id, reminder_text.upper()))
-
-            if alarm_job:
-                await self._remove_and_silence_alarm(alarm_job, reminder_text)
+            # Find the alarm via its reminder text
+            if (self.room.room_id, reminder_text.upper()) in ALARMS:
+                await self._remove_and_silence_alarm(reminder_text)
                 text = f"Alarm '{reminder_text}' silenced."
             else:
                 # We didn't find an alarm with that reminder text
@@ -387,33 +512,24 @@ class Command(object):
         else:
             # No reminder text provided. Check if there's a reminder currently firing
             # in the room instead then
-            for alarm_info, job in ALARMS.items():
-                if alarm_info[0] == self.room.room_id:
-                    # Found one!
-                    reminder_text = alarm_info[
-                        1
-                    ].capitalize()  # normalize the text a bit
-
-                    await self._remove_and_silence_alarm(job, reminder_text)
-                    text = f"Alarm '{reminder_text}' silenced."
-
-                    # Prevent the `else` clause from being triggered
-                    break
+            reminder = next(iter(ALARMS.in_room(self.room.room_id)), None)
+            if reminder:
+                # Found one!
+                reminder_text = reminder.reminder_text
+
+                await self._remove_and_silence_alarm(reminder_text)
+                text = f"Alarm '{reminder_text}' silenced."
             else:
                 # If we didn't find any alarms...
                 text = "No alarms are currently firing in this room."
 
         await send_text_to_room(self.client, self.room.room_id, text)
 
-    async def _remove_and_silence_alarm(self, alarm_job: Job, reminder_text: str):
-        # We found a reminder with an alarm. Remove it from the dict of current
-        # alarms
+    async def _remove_and_silence_alarm(self, reminder_text: str):
+        # We found a reminder with an alarm. Removing it from the dict of current
+        # alarms stops it from sounding again
         ALARMS.pop((self.room.room_id, reminder_text.upper()), None)
 
-        if SCHEDULER.get_job(alarm_job.id):
-            # Silence the alarm job
-            alarm_job.remove()
-
     @command_syntax("")
     async def _list_reminders(self):
         """Format and show known reminders for the current room
@@ -438,53 +554,40 @@ class Command(object):
         """
         output = ""
 
-        cron_reminder_lines = []
-        one_shot_reminder_lines = []
-        interval_reminder_lines = []
-
-        # Sort the reminder types
-        for reminder in REMINDERS.values():
-            # Filter out reminders that don't belong to this room
-            if reminder.room_id != self.room.room_id:
+        # Humanizing times and cron tabs is slow, so hand it off to a worker
+        reminders = []
+        for reminder in REMINDERS.in_room(self.room.room_id):
+            trigger = reminder.trigger
+            if isinstance(trigger, SpreadTrigger):
+                # Spread out reminders are the same kind as the trigger they follow
+                trigger = trigger.trigger
+
+            if isinstance(trigger, CronTrigger):
+                kind = "cron"
+            elif isinstance(trigger, DateTrigger):
+                kind = "one-shot"
+            elif isinstance(trigger, IntervalTrigger):
+                kind = "interval"
+            else:
                 continue
 
-            # Organise alarms into markdown lists
-            line = "- "
-            if reminder.alarm:
-                # Note that an alarm exists if available
-                alarm_clock_emoji = "⏰"
-                line += alarm_clock_emoji + " "
-
-            # Print the duration before (next) execution
-            next_execution = reminder.job.next_run_time
-            next_execution = arrow.get(next_execution)
-
-            # Cron-based reminders
-            if isinstance(reminder.job.trigger, CronTrigger):
-                # A human-readable cron tab, in addition to the actual tab
-                line += f"{prettify_cron(reminder.cron_tab)} (`{reminder.cron_tab}`); next run {next_execution.humanize()}"
-
-            # One-time reminders
-            elif isinstance(reminder.job.trigger, DateTrigger):
-                # Just print when the reminder will go off
-                line += f"{next_execution.humanize()}"
-
-            # Repeat reminders
-            elif isinstance(reminder.job.trigger, IntervalTrigger):
-                # Print the interval, and when it will next go off
-                line += f"every {readabledelta(reminder.recurse_timedelta)}; next run {next_execution.humanize()}"
-
-            # Add the reminder's text
-            line += f'; *"{reminder.reminder_text}"*'
-
-            # Output the status of each reminder. We divide up the reminders by type in order
-            # to show them in separate sections, and display them differently
-            if isinstance(reminder.job.trigger, CronTrigger):
-                cron_reminder_lines.append(line)
-            elif isinstance(reminder.job.trigger, DateTrigger):
-                one_shot_reminder_lines.append(line)
-            elif isinstance(reminder.job.trigger, IntervalTrigger):
-                interval_reminder_lines.append(line)
+            reminders.append(
+                (
+                    kind,
+                    reminder.alarm,
+                    reminder.cron_tab,
+                    reminder.recurse_timedelta,
+                    reminder.spread,
+                    reminder.next_fire_time(),
+                    reminder.reminder_text,
+                )
+            )
+
+        (
+            one_shot_reminder_lines,
+            cron_reminder_lines,
+            interval_reminder_lines,
+        ) = await WORKERS.run(_format_reminder_lines, reminders)
 
         if (
             not one_shot_reminder_lines
@@ -527,7 +630,7 @@ class Command(object):
         reminder = REMINDERS.get((self.room.room_id, reminder_text.upper()))
         if reminder:
             # Cancel the reminder and associated alarms
-            reminder.cancel()
+            await reminder.cancel()
 
             text = "Reminder cancelled."
         else:
@@ -1,6 +1,7 @@
+import functools
 import logging
 import re
-from typing import List
+from typing import Iterable, Pattern, Tuple
 
 from nio import (
     AsyncClient,
@@ -13,12 +14,15 @@ from nio import (
 
 from matrix_reminder_bot.bot_commands import Command
 from matrix_reminder_bot.config import CONFIG
-from matrix_reminder_bot.errors import CommandError
+from matrix_reminder_bot.errors import CommandError, WorkerPoolFullError
 from matrix_reminder_bot.functions import send_text_to_room
 from matrix_reminder_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
 
+# Formatting to strip from around incoming messages
+FORMATTING_CHARS = ("<p>", "\\n", "</p>")
+
 
 class Callbacks(object):
     """Callback methods that fire on certain matrix events
@@ -33,7 +37,7 @@ class Callbacks(object):
         self.store = store
 
     @staticmethod
-    def str_strip(s: str, phrases: List[str]) -> str:
+    def str_strip(s: str, phrases: Iterable[str]) -> str:
         """
         Strip instances of a string in leading and trailing positions around another string.
         Like str.rstrip but with strings instead of individual characters.
@@ -47,18 +51,17 @@ class Callbacks(object):
         s = s.strip()
 
         for phrase in phrases:
+            leading, trailing = _strip_patterns(phrase)
+
             # Use a regex to strip leading strings from another string
-            #
-            # We use re.S to treat the input text as one line (aka not strip leading
-            # phrases from every line of the message.
-            match = re.match(f"({phrase})*(.*)", s, flags=re.S)
+            match = leading.match(s)
 
             # Extract the text between the parentheses in the pattern above
             # Note that the above pattern is guaranteed to find a match, even with an empty str
             s = match.group(2)
 
             # Now attempt to strip trailing strings.
-            match = re.match(f"(.*)({phrase})$", s, flags=re.S)
+            match = trailing.match(s)
             if match:
                 s = match.group(1)
 
@@ -75,11 +78,16 @@ class Callbacks(object):
         if not event.body:
             return
 
+        # Most messages aren't commands, so turn those away before doing any more work.
+        # Stripping only ever removes text from the body, so a body that doesn't
+        # contain the command prefix can't start with it once stripped
+        if CONFIG.command_prefix not in event.body:
+            return
+
         # We do some stripping just to remove any surrounding formatting
-        formatting_chars = ["<p>", "\\n", "</p>"]
-        body = self.str_strip(event.body, formatting_chars)
+        body = self.str_strip(event.body, FORMATTING_CHARS)
         formatted_body = (
-            self.str_strip(event.formatted_body, formatting_chars)
+            self.str_strip(event.formatted_body, FORMATTING_CHARS)
             if event.formatted_body
             else None
         )
@@ -111,6 +119,12 @@ class Callbacks(object):
 
             # Print traceback
             logger.exception("CommandError while processing command:")
+        except WorkerPoolFullError:
+            # Too many commands are waiting to be processed. Turn this one away
+            msg = "I'm busy right now. Please try again in a moment."
+            await send_text_to_room(self.client, room.room_id, msg)
+
+            logger.warning("Worker pool full, rejected command in %s", room.room_id)
         except Exception as e:
             # An unknown error occurred. Inform the user
             msg = f"An unknown error occurred: {e}"
@@ -159,3 +173,18 @@ class Callbacks(object):
             user_msg,
             reply_to_event_id=event.event_id,
         )
+
+
+@functools.lru_cache(maxsize=None)
+def _strip_patterns(phrase: str) -> Tuple[Pattern, Pattern]:
+    """Compile the regexes that Callbacks.str_strip uses to strip a phrase
+
+    Returns:
+        A pattern matching any number of leading instances of the phrase, and a
+        pattern matching a single trailing instance. Both use re.S to treat the input
+        text as one line (aka not strip leading phrases from every line of the message).
+    """
+    return (
+        re.compile(f"({phrase})*(.*)", flags=re.S),
+        re.compile(f"(.*)({phrase})$", flags=re.S),
+    )
@@ -2,7 +2,8 @@ import logging
 import os
 import re
 import sys
-from typing import Any, List
+from datetime import timedelta
+from typing import Any, FrozenSet, List, Optional, Tuple
 
 import yaml
 
@@ -19,6 +20,71 @@ class DatabaseConfig:
         # The type of database. Supported types are 'sqlite' and 'postgres'
         self.type: str = ""
         self.connection_string: str = ""
+        # The maximum time in seconds that a change to a reminder may be held in memory
+        # before being written to the database. Changes made within this time of each
+        # other are committed together
+        self.max_write_delay: float = 0.0
+
+
+class WorkersConfig:
+    def __init__(self):
+        # The kind of pool that CPU-heavy work is run in. Either 'thread' or 'process'
+        self.type: str = ""
+        # The number of threads or processes in the pool
+        self.max_workers: int = 0
+        # The maximum amount of work that may be running or waiting to run in the pool
+        # at once. Commands that arrive once this is reached are turned away
+        self.max_queued: int = 0
+
+
+class ParsingConfig:
+    def __init__(self):
+        # The languages that dateparser tries when parsing times, e.g. ("en",). If
+        # None, all languages are tried
+        self.languages: Optional[Tuple[str, ...]] = None
+        # The locales that dateparser tries when parsing times, e.g. ("en-GB",). If
+        # None, locales are not restricted
+        self.locales: Optional[Tuple[str, ...]] = None
+        # The order to read ambiguous dates like 01/02/03 in, e.g. "DMY". If None, it
+        # depends on the language
+        self.date_order: Optional[str] = None
+
+
+class SyncConfig:
+    def __init__(self):
+        # Whether to ask the homeserver to only send the events that the bot uses
+        self.filter_enabled: bool = True
+        # Whether to only receive the members of a room that the bot needs to know
+        # about, rather than every member of every room
+        self.lazy_load_members: bool = True
+        # The maximum number of events per room to receive in each sync
+        self.timeline_limit: int = 0
+
+
+class OutboundConfig:
+    def __init__(self):
+        # The average number of messages that may be sent each second. If 0, the bot
+        # only slows down when the homeserver tells it to
+        self.messages_per_second: float = 0.0
+        # The number of messages that may be sent at once after a quiet period, before
+        # being held to messages_per_second
+        self.burst: int = 0
+        # The maximum number of messages that may be being sent at once
+        self.max_concurrent_sends: int = 0
+        # The number of times a message that fails to send is retried before giving up
+        self.max_retries: int = 0
+        # A file to record messages that couldn't be sent in, as JSON lines. If None,
+        # they are only logged
+        self.dead_letter_path: Optional[str] = None
+
+
+class MetricsConfig:
+    def __init__(self):
+        # Whether to serve metrics over HTTP for Prometheus to scrape
+        self.enabled: bool = False
+        # The address and port to serve metrics on
+        self.host: str = ""
+        self.port: int = 0
 
 
 class Config:
@@ -30,6 +96,11 @@ class Config:
         # TODO: Add some comments for each of these
         # TODO: Also ensure that this commit diff is sane. Did I replace config everywhere?
         self.database: DatabaseConfig = DatabaseConfig()
+        self.workers: WorkersConfig = WorkersConfig()
+        self.parsing: ParsingConfig = ParsingConfig()
+        self.sync: SyncConfig = SyncConfig()
+        self.outbound: OutboundConfig = OutboundConfig()
+        self.metrics: MetricsConfig = MetricsConfig()
         self.store_path: str = ""
 
         self.user_id: str = ""
@@ -41,6 +112,24 @@ class Config:
         self.command_prefix: str = ""
 
         self.timezone: str = ""
+        # How far ahead reminders are scheduled in memory. Reminders due later than
+        # this are picked up from the database when they come within range. If None,
+        # all reminders are kept scheduled
+        self.schedule_horizon: Optional[timedelta] = None
+        # Which scheduler engine runs reminders. Either 'apscheduler' or 'heap'
+        self.scheduler: str = ""
+        # How long to collect the reminders and alarms that go off in a room before
+        # sending them as a single message, in seconds. 0 disables digests
+        self.digest_window: float = 0
+        # The rooms that digests are used in. If empty, digests are used in all rooms
+        self.digest_rooms: FrozenSet[str] = frozenset()
+        # The window that repeating and cron reminders' fire times are spread over,
+        # so that reminders scheduled for the same time don't all fire at once. If
+        # None, reminders fire exactly when scheduled
+        self.spread: Optional[timedelta] = None
+        # How far ahead to prepare encryption sessions for the rooms that reminders
+        # are due in. If None, sessions are only prepared when reminders are sent
+        self.prewarm_window: Optional[timedelta] = None
 
     def read_config(self, filepath: str):
         if not os.path.isfile(filepath):
@@ -93,6 +182,15 @@ class Config:
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
+        max_write_delay_ms = self._get_cfg(
+            ["storage", "max_write_delay_ms"], default=100
+        )
+        if not isinstance(max_write_delay_ms, int) or max_write_delay_ms < 0:
+            raise ConfigError(
+                "storage.max_write_delay_ms must be a non-negative whole number"
+            )
+        self.database.max_write_delay = max_write_delay_ms / 1000
+
         self.store_path = self._get_cfg(["storage", "store_path"], default="store")
 
         # Create the store folder if it doesn't exist
@@ -122,6 +220,153 @@ class Config:
         # Reminder configuration
         self.timezone = self._get_cfg(["reminders", "timezone"], default="Etc/UTC")
 
+        schedule_horizon_hours = self._get_cfg(
+            ["reminders", "schedule_horizon_hours"], default=0, required=False
+        )
+        if (
+            not isinstance(schedule_horizon_hours, (int, float))
+            or schedule_horizon_hours < 0
+        ):
+            raise ConfigError(
+                "reminders.schedule_horizon_hours must be a non-negative number"
+            )
+        if schedule_horizon_hours:
+            self.schedule_horizon = timedelta(hours=schedule_horizon_hours)
+
+        self.scheduler = self._get_cfg(
+            ["reminders", "scheduler"], default="apscheduler"
+        )
+        if self.scheduler not in ("apscheduler", "heap"):
+            raise ConfigError("reminders.scheduler must be 'apscheduler' or 'heap'")
+
+        self.digest_window = self._get_cfg(
+            ["reminders", "digest_window_seconds"], default=0, required=False
+        )
+        if not isinstance(self.digest_window, (int, float)) or self.digest_window < 0:
+            raise ConfigError(
+                "reminders.digest_window_seconds must be a non-negative number"
+            )
+
+        digest_rooms = self._get_cfg(
+            ["reminders", "digest_rooms"], default=[], required=False
+        )
+        if not isinstance(digest_rooms, list) or not all(
+            isinstance(room_id, str) for room_id in digest_rooms
+        ):
+            raise ConfigError("reminders.digest_rooms must be a list of room IDs")
+        self.digest_rooms = frozenset(digest_rooms)
+
+        spread_seconds = self._get_cfg(
+            ["reminders", "spread_seconds"], default=0, required=False
+        )
+        if not isinstance(spread_seconds, int) or spread_seconds < 0:
+            raise ConfigError(
+                "reminders.spread_seconds must be a non-negative whole number"
+            )
+        if spread_seconds:
+            self.spread = timedelta(seconds=spread_seconds)
+
+        prewarm_minutes = self._get_cfg(
+            ["reminders", "prewarm_minutes"], default=5, required=False
+        )
+        if not isinstance(prewarm_minutes, (int, float)) or prewarm_minutes < 0:
+            raise ConfigError("reminders.prewarm_minutes must be a non-negative number")
+        if prewarm_minutes:
+            self.prewarm_window = timedelta(minutes=prewarm_minutes)
+
+        # Worker pool configuration
+        self.workers.type = self._get_cfg(["workers", "type"], default="thread")
+        if self.workers.type not in ("thread", "process"):
+            raise ConfigError("workers.type must be 'thread' or 'process'")
+
+        self.workers.max_workers = self._get_cfg(["workers", "max_workers"], default=2)
+        if (
+            not isinstance(self.workers.max_workers, int)
+            or self.workers.max_workers < 1
+        ):
+            raise ConfigError("workers.max_workers must be a positive whole number")
+
+        self.workers.max_queued = self._get_cfg(["workers", "max_queued"], default=100)
+        if not isinstance(self.workers.max_queued, int) or self.workers.max_queued < 1:
+            raise ConfigError("workers.max_queued must be a positive whole number")
+
+        # Time parsing configuration
+        for option in ("languages", "locales"):
+            values = self._get_cfg(["parsing", option], default=[], required=False)
+            if not isinstance(values, list) or not all(
+                isinstance(value, str) for value in values
+            ):
+                raise ConfigError(f"parsing.{option} must be a list of strings")
+            setattr(self.parsing, option, tuple(values) or None)
+
+        date_order = self._get_cfg(["parsing", "date_order"], required=False)
+        if date_order is not None:
+            date_order = str(date_order).upper()
+            if sorted(date_order) != ["D", "M", "Y"]:
+                raise ConfigError(
+                    "parsing.date_order must be an ordering of D, M and Y, e.g. 'DMY'"
+                )
+        self.parsing.date_order = date_order
+
+        # Sync configuration
+        for option in ("filter_enabled", "lazy_load_members"):
+            value = self._get_cfg(["sync", option], default=True)
+            if not isinstance(value, bool):
+                raise ConfigError(f"sync.{option} must be true or false")
+            setattr(self.sync, option, value)
+
+        self.sync.timeline_limit = self._get_cfg(["sync", "timeline_limit"], default=10)
+        if (
+            not isinstance(self.sync.timeline_limit, int)
+            or self.sync.timeline_limit < 1
+        ):
+            raise ConfigError("sync.timeline_limit must be a positive whole number")
+
+        # Outbound message configuration
+        self.outbound.messages_per_second = self._get_cfg(
+            ["outbound", "messages_per_second"], default=0, required=False
+        )
+        if (
+            not isinstance(self.outbound.messages_per_second, (int, float))
+            or self.outbound.messages_per_second < 0
+        ):
+            raise ConfigError(
+                "outbound.messages_per_second must be a non-negative number"
+            )
+
+        for option, default in (("burst", 10), ("max_concurrent_sends", 4)):
+            value = self._get_cfg(["outbound", option], default=default)
+            if not isinstance(value, int) or value < 1:
+                raise ConfigError(f"outbound.{option} must be a positive whole number")
+            setattr(self.outbound, option, value)
+
+        self.outbound.max_retries = self._get_cfg(
+            ["outbound", "max_retries"], default=5
+        )
+        if (
+            not isinstance(self.outbound.max_retries, int)
+            or self.outbound.max_retries < 0
+        ):
+            raise ConfigError(
+                "outbound.max_retries must be a non-negative whole number"
+            )
+
+        self.outbound.dead_letter_path = self._get_cfg(
+            ["outbound", "dead_letter_path"], required=False
+        )
+
+        # Metrics configuration
+        self.metrics.enabled = self._get_cfg(
+            ["metrics", "enabled"], default=False, required=False
+        )
+        if not isinstance(self.metrics.enabled, bool):
+            raise ConfigError("metrics.enabled must be true or false")
+
+        self.metrics.host = self._get_cfg(["metrics", "host"], default="127.0.0.1")
+        self.metrics.port = self._get_cfg(["metrics", "port"], default=9102)
+        if not isinstance(self.metrics.port, int) or not 0 < self.metrics.port < 65536:
+            raise ConfigError("metrics.port must be a valid port number")
+
     def _get_cfg(
         self,
         path: List[str],
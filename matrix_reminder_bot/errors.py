@@ -26,3 +26,10 @@ class CommandSyntaxError(RuntimeError):
 
     def __init__(self):
         super().__init__()
+
+
+class WorkerPoolFullError(RuntimeError):
+    """An error encountered if too much work is waiting for the worker pool"""
+
+    def __init__(self):
+        super().__init__()
@@ -1,11 +1,12 @@
 import logging
 from typing import Callable, Optional
 
-from markdown import markdown
-from nio import AsyncClient, SendRetryError
+from nio import AsyncClient
 
 from matrix_reminder_bot.config import CONFIG
-from matrix_reminder_bot.errors import CommandSyntaxError
+from matrix_reminder_bot.errors import CommandSyntaxError, WorkerPoolFullError
+from matrix_reminder_bot.outbound import OUTBOUND, Priority
+from matrix_reminder_bot.workers import WORKERS
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +18,8 @@ async def send_text_to_room(
     notice: bool = True,
     markdown_convert: bool = True,
     reply_to_event_id: Optional[str] = None,
+    priority: Priority = Priority.REPLY,
+    on_done: Optional[Callable[[bool], None]] = None,
 ):
     """Send text to a matrix room.
 
@@ -35,6 +38,12 @@ async def send_text_to_room(
 
         reply_to_event_id: Whether this message is a reply to another event. The event
             ID this is message is a reply to.
+
+        priority: How urgently the message needs to be sent, compared to others that
+            are waiting. Defaults to a reply to a command.
+
+        on_done: Optional. Called with whether the message was sent, once it has been,
+            or has been given up on.
     """
     # Determine whether to ping room members or not
     msgtype = "m.notice" if notice else "m.text"
@@ -46,20 +55,25 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
-        content["formatted_body"] = markdown(message)
+        try:
+            content["formatted_body"] = await WORKERS.run(_markdown_to_html, message)
+        except WorkerPoolFullError:
+            # Don't drop the message just because the bot is busy
+            content["formatted_body"] = _markdown_to_html(message)
 
     if reply_to_event_id:
         content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
-    try:
-        await client.room_send(
-            room_id,
-            "m.room.message",
-            content,
-            ignore_unverified_devices=True,
-        )
-    except SendRetryError:
-        logger.exception(f"Unable to send message response to {room_id}")
+    # Messages are sent in the background, in order, and retried if they fail
+    OUTBOUND.put(room_id, content, priority, on_done)
+
+
+def _markdown_to_html(message: str) -> str:
+    """Convert markdown to HTML"""
+    # markdown takes a while to import, so only do so once it's needed
+    from markdown import markdown
+
+    return markdown(message)
 
 
 def command_syntax(syntax: str):
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
+import signal
 import sys
-from time import sleep
+from typing import Any, Dict, Union
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
-from apscheduler.schedulers import SchedulerAlreadyRunningError
 from nio import (
     AsyncClient,
     AsyncClientConfig,
@@ -14,15 +14,96 @@ from nio import (
     LoginError,
     MegolmEvent,
     RoomMessageText,
+    SyncResponse,
+    UploadFilterError,
 )
 
 from matrix_reminder_bot.callbacks import Callbacks
 from matrix_reminder_bot.config import CONFIG
-from matrix_reminder_bot.reminder import SCHEDULER
+from matrix_reminder_bot.metrics import start_metrics_server
+from matrix_reminder_bot.outbound import OUTBOUND, backoff_delay
+from matrix_reminder_bot.reminder import (
+    DIGESTS,
+    MISFIRE_GRACE_TIME,
+    SCHEDULER,
+    get_scheduler,
+    start_prewarming,
+)
 from matrix_reminder_bot.storage import Storage
+from matrix_reminder_bot.time_parsing import parser_options, warm_up
+from matrix_reminder_bot.workers import WORKERS
 
 logger = logging.getLogger(__name__)
 
+# The types of room event that the bot needs to see as they happen. Membership and
+# encryption events are needed to know who to encrypt messages for
+TIMELINE_EVENT_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.room.member",
+    "m.room.encryption",
+]
+
+
+async def warm_up_time_parser():
+    """Load the time parser's language data, rather than waiting for the first command"""
+    try:
+        await WORKERS.warm_up(warm_up, CONFIG.timezone, parser_options())
+    except Exception:
+        logger.exception("Unable to warm up the time parser:")
+    else:
+        logger.debug("Time parser warmed up")
+
+
+# How long to wait before trying to reconnect to the homeserver, in seconds. The wait
+# doubles after each failed attempt in a row, up to the maximum
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+
+# How long to keep sending queued messages for when asked to shut down, in seconds
+SHUTDOWN_SEND_TIMEOUT = 5
+
+
+def reconnect_delay(failures: int) -> float:
+    """How long to wait before reconnecting after a number of failed attempts in a row"""
+    return backoff_delay(failures, RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+
+
+def get_sync_filter() -> Dict[str, Any]:
+    """The filter to sync with, which leaves out everything the bot doesn't use"""
+    nothing = {"not_types": ["*"]}
+    return {
+        "presence": nothing,
+        "account_data": nothing,
+        "room": {
+            "state": {"lazy_load_members": CONFIG.sync.lazy_load_members},
+            "timeline": {
+                "types": TIMELINE_EVENT_TYPES,
+                "limit": CONFIG.sync.timeline_limit,
+                "lazy_load_members": CONFIG.sync.lazy_load_members,
+            },
+            "ephemeral": nothing,
+            "account_data": nothing,
+        },
+    }
+
+
+async def upload_sync_filter(client: AsyncClient) -> Union[str, Dict[str, Any]]:
+    """Upload the sync filter to the homeserver
+
+    Returns:
+        The ID of the uploaded filter, or the filter itself if it couldn't be uploaded,
+        in which case it is sent along with every sync instead
+    """
+    sync_filter = get_sync_filter()
+    response = await client.upload_filter(**sync_filter)
+    if isinstance(response, UploadFilterError):
+        logger.warning("Unable to upload sync filter: %s", response.message)
+        return sync_filter
+
+    logger.debug("Uploaded sync filter %s", response.filter_id)
+    return response.filter_id
+
 
 async def main():
     # Read config file
@@ -34,7 +115,12 @@ async def main():
     CONFIG.read_config(config_filepath)
 
     # Configure the python job scheduler
-    SCHEDULER.configure({"apscheduler.timezone": CONFIG.timezone})
+    SCHEDULER.configure(
+        {
+            "apscheduler.timezone": CONFIG.timezone,
+            "apscheduler.job_defaults.misfire_grace_time": MISFIRE_GRACE_TIME,
+        }
+    )
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -55,6 +141,7 @@ async def main():
 
     # Configure the database
     store = Storage(client)
+    await store.setup()
 
     # Set up event callbacks
     callbacks = Callbacks(client, store)
@@ -62,62 +149,147 @@ async def main():
     client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
     client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            # Try to login with the configured username/password
+    # Whether a sync has completed since the bot started. The full state of every
+    # room is only requested the first time, as it's kept in memory after that
+    initial_sync_done = False
+    # The number of attempts to connect that have failed in a row
+    failures = 0
+
+    async def on_sync(response: SyncResponse):
+        nonlocal initial_sync_done, failures
+        initial_sync_done = True
+        failures = 0
+
+        # Send anything that was queued while the homeserver was unreachable
+        OUTBOUND.connected()
+
+    client.add_response_callback(on_sync, (SyncResponse,))
+
+    # Shut down gracefully when asked to stop, so that queued database writes are not
+    # lost
+    main_task = asyncio.current_task()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, main_task.cancel)
+
+    # Send messages in the background once connected
+    OUTBOUND.start(client)
+
+    metrics_runner = None
+    if CONFIG.metrics.enabled:
+        metrics_runner = await start_metrics_server(
+            CONFIG.metrics.host, CONFIG.metrics.port
+        )
+
+    # Allow jobs to fire. This doesn't wait for the bot to connect, so that reminders
+    # still fire on time while the homeserver can't be reached. Their messages are
+    # queued up and sent once it can be
+    get_scheduler().start()
+
+    # Prepare encryption sessions for the rooms that reminders are about to fire in
+    start_prewarming()
+
+    warm_up_task = None
+    sync_filter = None
+    try:
+        # Keep trying to reconnect on failure (with some time in-between)
+        while True:
             try:
-                login_response = await client.login(
-                    password=CONFIG.user_password,
-                    device_name=CONFIG.device_name,
-                )
+                # Try to login with the configured username/password
+                try:
+                    login_response = await client.login(
+                        password=CONFIG.user_password,
+                        device_name=CONFIG.device_name,
+                    )
 
-                # Check if login failed. Usually incorrect password
-                if type(login_response) == LoginError:
-                    logger.error("Failed to login: %s", login_response.message)
-                    logger.warning("Trying again in 15s...")
-
-                    # Sleep so we don't bombard the server with login requests
-                    sleep(15)
-                    continue
-            except LocalProtocolError as e:
-                # There's an edge case here where the user hasn't installed the correct C
-                # dependencies. In that case, a LocalProtocolError is raised on login.
-                logger.fatal(
-                    "Failed to login. Have you installed the correct dependencies? "
-                    "https://github.com/poljar/matrix-nio#installation "
-                    "Error: %s",
-                    e,
+                    # Check if login failed. Usually incorrect password
+                    if type(login_response) == LoginError:
+                        logger.error("Failed to login: %s", login_response.message)
+
+                        # Wait so we don't bombard the server with login requests
+                        failures += 1
+                        delay = reconnect_delay(failures)
+                        logger.warning("Trying again in %.1fs...", delay)
+                        await asyncio.sleep(delay)
+                        continue
+                except LocalProtocolError as e:
+                    # There's an edge case here where the user hasn't installed the
+                    # correct C dependencies. In that case, a LocalProtocolError is
+                    # raised on login.
+                    logger.fatal(
+                        "Failed to login. Have you installed the correct dependencies? "
+                        "https://github.com/poljar/matrix-nio#installation "
+                        "Error: %s",
+                        e,
+                    )
+                    return False
+
+                # Login succeeded!
+
+                logger.info(f"Logged in as {CONFIG.user_id}")
+                logger.info("Startup complete")
+
+                if warm_up_task is None:
+                    # Load the time parser's language data in the background, so
+                    # that it's ready for the first command without holding up
+                    # startup
+                    warm_up_task = asyncio.ensure_future(warm_up_time_parser())
+
+                # Only upload the sync filter once, rather than on every reconnect
+                if CONFIG.sync.filter_enabled and sync_filter is None:
+                    sync_filter = await upload_sync_filter(client)
+
+                await client.sync_forever(
+                    timeout=30000,
+                    sync_filter=sync_filter,
+                    full_state=not initial_sync_done,
                 )
-                return False
 
-            # Login succeeded!
+            except asyncio.CancelledError:
+                # We've been asked to shut down. Send any digests that are still being
+                # collected, and anything else that's queued, while still connected
+                await DIGESTS.flush_all()
+                await OUTBOUND.drain(SHUTDOWN_SEND_TIMEOUT)
+                raise
+            except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
+                failures += 1
+                delay = reconnect_delay(failures)
+                logger.warning(
+                    "Unable to connect to homeserver, retrying in %.1fs...", delay
+                )
 
-            logger.info(f"Logged in as {CONFIG.user_id}")
-            logger.info("Startup complete")
+                # Wait so we don't bombard the server with login requests
+                await asyncio.sleep(delay)
+            except Exception:
+                failures += 1
+                delay = reconnect_delay(failures)
+                logger.exception("Unknown exception occurred:")
+                logger.warning("Restarting in %.1fs...", delay)
 
-            # Allow jobs to fire
-            try:
-                SCHEDULER.start()
-            except SchedulerAlreadyRunningError:
-                pass
-
-            await client.sync_forever(timeout=30000, full_state=True)
-
-        except (ClientConnectionError, ServerDisconnectedError, TimeoutError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        except Exception:
-            logger.exception("Unknown exception occurred:")
-            logger.warning("Restarting in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+                # Wait so we don't bombard the server with login requests
+                await asyncio.sleep(delay)
+            finally:
+                # Make sure to close the client connection on disconnect
+                await client.close()
+                OUTBOUND.disconnected()
+    except asyncio.CancelledError:
+        logger.info("Shutting down...")
+    finally:
+        if warm_up_task is not None:
+            warm_up_task.cancel()
+        # Stop firing reminders and sounding alarms first, so that nothing can queue
+        # a database write once the store has been closed
+        get_scheduler().shutdown(wait=False)
+        # If the bot wasn't connected, digests that were still being collected are
+        # counted among the messages that weren't sent
+        await DIGESTS.flush_all()
+        OUTBOUND.stop()
+        if OUTBOUND:
+            logger.warning("%d queued messages were not sent", len(OUTBOUND))
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await store.close()
+        WORKERS.shutdown()
 
 
 if __name__ == "__main__":
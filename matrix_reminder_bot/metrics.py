@@ -0,0 +1,225 @@
+import logging
+import math
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# The prefix given to the names of all of the bot's metrics
+PREFIX = "matrix_reminder_bot_"
+
+# The default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value: str) -> str:
+    """Escape a label value for the text format"""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric(object):
+    # The Prometheus metric type
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """A measurement of the bot, reported in Prometheus' text format
+
+        Args:
+            name: The name of the metric, without PREFIX
+            documentation: A description of what's being measured
+            labelnames: The names of the labels that the metric is split up by. Values
+                for these are passed, in the same order, whenever the metric is
+                updated
+        """
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _labels(self, labelvalues: Tuple[str, ...], **extra: str) -> str:
+        """Format a set of label values the way they appear in the text format"""
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra.items())
+        if not pairs:
+            return ""
+
+        labels = ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs)
+        return "{" + labels + "}"
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ] + self._samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        """A count of something that has happened since the bot started
+
+        By convention, the names of counters end in "_total".
+        """
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{self._labels(labelvalues)} {value}"
+            for labelvalues, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        """A value that can go up and down, such as the length of a queue"""
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labelvalues: str):
+        self._values[labelvalues] = value
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues: str, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{self._labels(labelvalues)} {value}"
+            for labelvalues, value in self._values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        """The distribution of a measurement, such as how long something took
+
+        Args:
+            buckets: The upper bounds of the buckets that measurements are counted in
+        """
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # The number of measurements in each bucket, and the sum of all measurements,
+        # for each set of label values
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        counts = self._counts.get(labelvalues)
+        if counts is None:
+            counts = self._counts[labelvalues] = [0] * len(self.buckets)
+            self._sums[labelvalues] = 0.0
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._sums[labelvalues] += value
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for labelvalues, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                samples.append(
+                    f"{self.name}_bucket{self._labels(labelvalues, le=le)} "
+                    f"{cumulative}"
+                )
+            labels = self._labels(labelvalues)
+            samples.append(f"{self.name}_sum{labels} {self._sums[labelvalues]}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        """All of the bot's metrics"""
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Render every metric in Prometheus' text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """Create and register a Counter"""
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """Create and register a Gauge"""
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    labelnames: Sequence[str] = (),
+    buckets: Sequence[float] = DEFAULT_BUCKETS,
+) -> Histogram:
+    """Create and register a Histogram"""
+    return REGISTRY.register(
+        Histogram(name, documentation, labelnames, buckets=buckets)
+    )
+
+
+async def _metrics_handler(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+
+    return web.Response(
+        body=REGISTRY.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> Optional["web.AppRunner"]:
+    """Serve the bot's metrics over HTTP at /metrics, for Prometheus to scrape
+
+    Returns:
+        The runner for the server, which should be cleaned up on shutdown, or None if
+        the server couldn't be started
+    """
+    # aiohttp.web takes a while to import, so only do so if metrics are enabled
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        logger.exception(f"Unable to serve metrics on {host}:{port}:")
+        await runner.cleanup()
+        return None
+
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
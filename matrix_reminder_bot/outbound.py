@@ -0,0 +1,463 @@
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+import uuid
+from collections import deque
+from enum import IntEnum
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from aiohttp import ClientConnectionError
+from nio import AsyncClient, RoomSendError
+
+from matrix_reminder_bot import metrics
+from matrix_reminder_bot.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# The errors raised when the homeserver can't be reached
+CONNECTION_ERRORS = (ClientConnectionError, asyncio.TimeoutError, TimeoutError)
+
+# How long to wait before retrying a message that failed to send, in seconds. The wait
+# doubles after each failed attempt, up to the maximum
+RETRY_MIN_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+# How long to stop sending for if the homeserver says that the bot is sending too
+# quickly, but not how long to wait, in milliseconds
+DEFAULT_RETRY_AFTER_MS = 5000
+
+
+# Transaction IDs only need to be unique to the bot's device, so rather than generating
+# a UUID for every message, which is slow enough to matter when thousands of reminders
+# fire at once, they're made up of a prefix that's different every time the bot starts
+# and a counter
+_TXN_ID_PREFIX = uuid.uuid4().hex
+_txn_ids = itertools.count()
+
+
+class Priority(IntEnum):
+    """How urgently a message needs to be sent. Lower values are sent first"""
+
+    # A reminder that has come due
+    REMINDER = 0
+    # An alarm going off for a reminder that hasn't been silenced
+    ALARM = 1
+    # A reply to a command, or a notice about something the bot couldn't do
+    REPLY = 2
+
+
+QUEUE_DEPTH = metrics.gauge(
+    "outbound_queue_depth", "Messages waiting to be sent", ["priority"]
+)
+WAIT_TIME = metrics.histogram(
+    "outbound_wait_seconds",
+    "Time from a message being queued to it being sent",
+    ["priority"],
+)
+SENT = metrics.counter("outbound_sent_total", "Messages sent", ["priority"])
+DEAD_LETTERS = metrics.counter(
+    "outbound_dead_letters_total",
+    "Messages that were given up on after failing to send",
+    ["priority"],
+)
+RATE_LIMITED = metrics.counter(
+    "outbound_rate_limited_total",
+    "Times the homeserver said the bot was sending too quickly",
+)
+
+for _priority in Priority:
+    QUEUE_DEPTH.set(0, _priority.name.lower())
+
+
+def backoff_delay(failures: int, min_delay: float, max_delay: float) -> float:
+    """How long to wait after a number of failed attempts in a row, in seconds
+
+    The delay doubles after each failure, up to max_delay. It's randomised a little,
+    so that things which all failed at the same time aren't all retried at once.
+    """
+    delay = min_delay * 2 ** min(failures - 1, 16)
+    return min(delay, max_delay) * random.uniform(0.5, 1)
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: int):
+        """Limits how often something may happen, while allowing short bursts
+
+        Args:
+            rate: The number of tokens added to the bucket each second
+            capacity: The most tokens that can be saved up in the bucket
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def take(self):
+        """Wait until there's a token in the bucket, then take it"""
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+    def empty(self):
+        """Throw away any saved up tokens"""
+        self._refill()
+        self._tokens = min(self._tokens, 0)
+
+
+class OutboundMessage(object):
+    __slots__ = (
+        "room_id",
+        "content",
+        "priority",
+        "on_done",
+        "txn_id",
+        "attempts",
+        "queued_at",
+    )
+
+    def __init__(
+        self,
+        room_id: str,
+        content: Dict[str, Any],
+        priority: Priority,
+        on_done: Optional[Callable[[bool], None]] = None,
+    ):
+        """A message event waiting to be sent to a room
+
+        Args:
+            room_id: The room to send the message to
+            content: The content of the message event
+            priority: How urgently the message needs to be sent
+            on_done: Optional. Called with whether the message was sent, once it has
+                been, or has been given up on
+        """
+        self.room_id = room_id
+        self.content = content
+        self.priority = priority
+        self.on_done = on_done
+        # Retries use the same transaction ID, so that the homeserver can tell that a
+        # message it already received is being sent again
+        self.txn_id = f"{_TXN_ID_PREFIX}.{next(_txn_ids)}"
+        # The number of failed attempts to send the message. Being told to slow down
+        # or being unable to reach the homeserver don't count
+        self.attempts = 0
+        # When the message was queued, in time.monotonic() seconds
+        self.queued_at = time.monotonic()
+
+
+class RoomQueue(object):
+    __slots__ = ("lanes", "ready_priority")
+
+    def __init__(self):
+        """The messages waiting to be sent to a room"""
+        # The messages of each priority, oldest first
+        self.lanes: List[Deque[OutboundMessage]] = [deque() for _ in Priority]
+        # The priority of the lane that the room is waiting in to send its next
+        # message, or None if it's sending a message or waiting to retry one
+        self.ready_priority: Optional[Priority] = None
+
+    def __len__(self) -> int:
+        return sum(len(lane) for lane in self.lanes)
+
+    def next_message(self) -> Optional[OutboundMessage]:
+        """The message that should be sent next, i.e. the oldest most urgent one"""
+        for lane in self.lanes:
+            if lane:
+                return lane[0]
+        return None
+
+
+class OutboundQueue(object):
+    def __init__(self):
+        """The queue that every message the bot sends goes through
+
+        Messages are sent no faster than `outbound.messages_per_second`, and the whole
+        queue waits when the homeserver says the bot is sending too quickly. Messages
+        that fail to send are retried with backoff, and recorded as dead letters if
+        they still fail after `outbound.max_retries` retries.
+
+        More urgent messages are sent first, so that a long reply to a command can't
+        hold up a reminder that's due. Messages of the same priority to the same room
+        are sent one at a time, in the order they were queued in, but a room that's
+        waiting to retry a message doesn't hold up the others. Nothing is sent while
+        the bot isn't connected to the homeserver.
+        """
+        self.client: Optional[AsyncClient] = None
+
+        # The messages waiting to be sent to each room. A room is only in here while
+        # it has messages waiting
+        self._rooms: Dict[str, RoomQueue] = {}
+        # For each priority, the rooms whose next message has that priority and can
+        # be sent now, in the order they became ready. A room may be left behind in a
+        # lane after moving to a more urgent one, in which case it is skipped
+        self._ready: List[Deque[str]] = [deque() for _ in Priority]
+
+        self._connected = False
+        # When sending can resume after the homeserver asked the bot to slow down, in
+        # time.monotonic() seconds
+        self._paused_until = 0.0
+
+        # These are created once there's an event loop to create them in
+        self._wakeup: Optional[asyncio.Event] = None
+        self._send_slots: Optional[asyncio.Semaphore] = None
+        self._bucket: Optional[TokenBucket] = None
+        self._task: Optional[asyncio.Future] = None
+        self._sending: Set[asyncio.Future] = set()
+
+    def __len__(self) -> int:
+        return sum(len(room) for room in self._rooms.values())
+
+    def start(self, client: AsyncClient):
+        """Start sending messages in the background, once connected"""
+        self.client = client
+        self._wakeup = asyncio.Event()
+        self._send_slots = asyncio.Semaphore(CONFIG.outbound.max_concurrent_sends)
+        if CONFIG.outbound.messages_per_second:
+            self._bucket = TokenBucket(
+                CONFIG.outbound.messages_per_second, CONFIG.outbound.burst
+            )
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stop sending messages. Any that are still queued are not sent"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._sending:
+            task.cancel()
+
+    async def drain(self, timeout: float):
+        """Wait for every queued message to be sent, or given up on
+
+        Args:
+            timeout: The longest to wait, in seconds. Waiting also stops if the bot
+                loses its connection to the homeserver
+        """
+        deadline = time.monotonic() + timeout
+        while (self or self._sending) and self._connected and self._task is not None:
+            if time.monotonic() >= deadline:
+                return
+            await asyncio.sleep(0.1)
+
+    def connected(self):
+        """Called when the bot has synced with the homeserver"""
+        if not self._connected:
+            self._connected = True
+            self._wake()
+
+    def disconnected(self):
+        """Called when the bot has lost its connection to the homeserver"""
+        self._connected = False
+
+    def put(
+        self,
+        room_id: str,
+        content: Dict[str, Any],
+        priority: Priority = Priority.REPLY,
+        on_done: Optional[Callable[[bool], None]] = None,
+    ):
+        """Queue an m.room.message event to be sent to a room
+
+        Args:
+            on_done: Optional. Called with whether the message was sent, once it has
+                been, or has been given up on
+        """
+        message = OutboundMessage(room_id, content, priority, on_done)
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = RoomQueue()
+            room.lanes[priority].append(message)
+            self._set_ready(room_id)
+        else:
+            room.lanes[priority].append(message)
+
+            # Move the room to a more urgent lane if it's waiting in a less urgent one
+            if room.ready_priority is not None and priority < room.ready_priority:
+                self._set_ready(room_id)
+
+        QUEUE_DEPTH.inc(priority.name.lower())
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _set_ready(self, room_id: str, retry: bool = False):
+        """Mark a room as ready to send its next message
+
+        Args:
+            room_id: The room
+            retry: Whether a message is being retried straight away, in which case it
+                is sent before the messages of rooms that haven't had a go yet
+        """
+        room = self._rooms[room_id]
+        room.ready_priority = room.next_message().priority
+
+        lane = self._ready[room.ready_priority]
+        if retry:
+            lane.appendleft(room_id)
+        else:
+            lane.append(room_id)
+        self._wake()
+
+    def _next_ready_room(self) -> Optional[str]:
+        """Take the room with the most urgent message that can be sent now"""
+        for priority, lane in zip(Priority, self._ready):
+            while lane:
+                room_id = lane.popleft()
+                room = self._rooms.get(room_id)
+                if room is not None and room.ready_priority == priority:
+                    room.ready_priority = None
+                    return room_id
+        return None
+
+    def _done(self, message: OutboundMessage, sent: bool):
+        """Remove a message that has been dealt with, and move on to the room's next
+
+        Args:
+            message: The message
+            sent: Whether the message was sent, rather than given up on
+        """
+        if message.on_done is not None:
+            try:
+                message.on_done(sent)
+            except Exception:
+                logger.exception("Error in callback for message to %s", message.room_id)
+
+        room = self._rooms[message.room_id]
+        room.lanes[message.priority].popleft()
+        QUEUE_DEPTH.dec(message.priority.name.lower())
+
+        if room.next_message() is not None:
+            self._set_ready(message.room_id)
+        else:
+            del self._rooms[message.room_id]
+
+    async def _run(self):
+        while True:
+            # Wait for a message to send
+            room_id = self._next_ready_room() if self._connected else None
+            while room_id is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                room_id = self._next_ready_room() if self._connected else None
+            message = self._rooms[room_id].next_message()
+
+            # Wait until it's allowed to be sent
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self._bucket is not None:
+                await self._bucket.take()
+            await self._send_slots.acquire()
+
+            task = asyncio.ensure_future(self._send(message))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, message: OutboundMessage):
+        room_id = message.room_id
+        try:
+            try:
+                response = await self.client.room_send(
+                    room_id,
+                    "m.room.message",
+                    message.content,
+                    tx_id=message.txn_id,
+                    ignore_unverified_devices=True,
+                )
+            except CONNECTION_ERRORS:
+                # Try again once the bot has reconnected
+                logger.warning(
+                    "Unable to reach homeserver, holding %d messages until it can be",
+                    len(self),
+                )
+                self.disconnected()
+                self._set_ready(room_id, retry=True)
+                return
+            except Exception as e:
+                error = repr(e)
+            else:
+                if not isinstance(response, RoomSendError):
+                    priority = message.priority.name.lower()
+                    WAIT_TIME.observe(time.monotonic() - message.queued_at, priority)
+                    SENT.inc(priority)
+                    self._done(message, sent=True)
+                    return
+
+                if response.status_code == "M_LIMIT_EXCEEDED":
+                    # Stop sending anything until the homeserver says that it's OK
+                    retry_after_ms = response.retry_after_ms or DEFAULT_RETRY_AFTER_MS
+                    logger.warning(
+                        "Rate limited by homeserver, pausing sending for %dms",
+                        retry_after_ms,
+                    )
+                    RATE_LIMITED.inc()
+                    self._paused_until = max(
+                        self._paused_until, time.monotonic() + retry_after_ms / 1000
+                    )
+                    if self._bucket is not None:
+                        self._bucket.empty()
+                    self._set_ready(room_id, retry=True)
+                    return
+
+                error = f"{response.status_code}: {response.message}"
+
+            message.attempts += 1
+            if message.attempts > CONFIG.outbound.max_retries:
+                self._dead_letter(message, error)
+                self._done(message, sent=False)
+                return
+
+            delay = backoff_delay(message.attempts, RETRY_MIN_DELAY, RETRY_MAX_DELAY)
+            logger.warning(
+                "Unable to send message to %s (%s), retrying in %.1fs",
+                room_id,
+                error,
+                delay,
+            )
+            asyncio.get_event_loop().call_later(delay, self._set_ready, room_id)
+        finally:
+            self._send_slots.release()
+
+    def _dead_letter(self, message: OutboundMessage, error: str):
+        """Record a message that couldn't be sent, so that it isn't lost without trace"""
+        logger.error(
+            "Giving up on message to %s after %d attempts: %s",
+            message.room_id,
+            message.attempts,
+            error,
+        )
+        DEAD_LETTERS.inc(message.priority.name.lower())
+
+        if not CONFIG.outbound.dead_letter_path:
+            return
+
+        record = {
+            "time": time.time(),
+            "room_id": message.room_id,
+            "priority": message.priority.name.lower(),
+            "txn_id": message.txn_id,
+            "attempts": message.attempts,
+            "error": error,
+            "content": message.content,
+        }
+        try:
+            with open(CONFIG.outbound.dead_letter_path, "a") as dead_letters:
+                dead_letters.write(json.dumps(record) + "\n")
+        except OSError:
+            logger.exception("Unable to write to the dead letter log:")
+
+
+OUTBOUND = OutboundQueue()
@@ -1,18 +1,46 @@
+import asyncio
+import functools
+import heapq
+import itertools
 import logging
+import sys
+import time
+import zlib
+from collections import namedtuple
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    ValuesView,
+)
 
 import pytz
-from apscheduler.job import Job
+from apscheduler.events import (
+    EVENT_JOB_ERROR,
+    EVENT_JOB_EXECUTED,
+    EVENT_JOB_SUBMITTED,
+    JobExecutionEvent,
+    JobSubmissionEvent,
+)
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.base import BaseTrigger
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.util import timedelta_seconds
 from nio import AsyncClient
 
+from matrix_reminder_bot import metrics
 from matrix_reminder_bot.config import CONFIG
 from matrix_reminder_bot.functions import make_pill, send_text_to_room
+from matrix_reminder_bot.outbound import Priority
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +50,368 @@ SCHEDULER = AsyncIOScheduler()
 # How often an alarm should sound after the reminder it's attached to
 ALARM_TIMEDELTA = timedelta(minutes=5)
 
+# How often to check for ringing alarms that are due to sound again
+ALARM_TICK_INTERVAL = timedelta(seconds=10)
+
+# The longest time a TimerHeap will sleep before checking the time again. This guards
+# against changes to the system clock
+TIMER_HEAP_MAX_SLEEP = 60
+
+# How late APScheduler may start a reminder's job before skipping it, in seconds. When
+# many reminders fire at once, it can take the scheduler a few seconds just to start
+# all of their jobs
+MISFIRE_GRACE_TIME = 60
+
+# The buckets that reminders' lateness is counted in, in seconds
+LATENESS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+FIRE_LATENESS = metrics.histogram(
+    "reminder_fire_lateness_seconds",
+    "How long after they were due reminders and alarms started being sent",
+    ["trigger", "kind"],
+    buckets=LATENESS_BUCKETS,
+)
+DELIVERY_LATENESS = metrics.histogram(
+    "reminder_delivery_lateness_seconds",
+    "How long after they were due reminders and alarms were sent, or given up on",
+    ["trigger", "kind", "outcome"],
+    buckets=LATENESS_BUCKETS,
+)
+
+# How often to check that rooms with reminders due soon have an encryption session
+# ready to send them with
+PREWARM_INTERVAL = timedelta(minutes=1)
+
+
+class TimerJob(object):
+    """A job scheduled on a TimerHeap
+
+    Args:
+        scheduler: The TimerHeap this job belongs to
+        job_id: A unique ID for this job
+        func: The coroutine function to call when the job fires
+        trigger: The trigger which determines when the job fires
+        next_run_time: When the job will next fire
+    """
+
+    __slots__ = ("scheduler", "id", "func", "trigger", "next_run_time")
+
+    def __init__(
+        self,
+        scheduler: "TimerHeap",
+        job_id: int,
+        func: Callable[[], Awaitable],
+        trigger: BaseTrigger,
+        next_run_time: datetime,
+    ):
+        self.scheduler = scheduler
+        self.id = job_id
+        self.func = func
+        self.trigger = trigger
+        self.next_run_time = next_run_time
+
+    def remove(self):
+        """Unschedule this job"""
+        self.scheduler.remove_job(self.id)
+
+
+class TimerHeap(object):
+    """A lightweight scheduler that keeps all jobs in a single heap, ordered by when
+    they next fire, and sleeps until the earliest one is due
+
+    This implements the subset of the APScheduler interface that the bot uses, and
+    accepts the same trigger objects, so it can be used in place of SCHEDULER. Unlike
+    APScheduler, runs that were missed (e.g. while the event loop was busy) are never
+    skipped, but coalesced into a single run.
+    """
+
+    def __init__(self):
+        # Entries of (next run timestamp, job ID, job). Removed jobs are left in the
+        # heap and skipped once they reach the top
+        self._heap: List[Tuple[float, int, TimerJob]] = []
+        self._jobs: Dict[int, TimerJob] = {}
+        self._job_ids = itertools.count()
+
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._wakeup_time: Optional[float] = None
+        # Jobs that are currently running
+        self._running_jobs: Set[asyncio.Future] = set()
+        self.running = False
+
+    def start(self):
+        """Start running jobs as they become due"""
+        self.running = True
+        self._schedule_wakeup()
+
+    def shutdown(self, wait: bool = True):
+        """Stop running jobs, and cancel those that are running now
+
+        Args:
+            wait: Ignored. Accepted so that this can be called like APScheduler's
+                shutdown, which can't wait for coroutine jobs either
+        """
+        self.running = False
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+            self._wakeup_time = None
+
+        for future in self._running_jobs:
+            future.cancel()
+        self._running_jobs.clear()
+
+    def add_job(
+        self, func: Callable[[], Awaitable], trigger: BaseTrigger
+    ) -> Optional[TimerJob]:
+        """Schedule a coroutine function to be called whenever a trigger fires
+
+        Returns:
+            The scheduled job, or None if the trigger will never fire
+        """
+        next_run_time = trigger.get_next_fire_time(None, datetime.now(tz=pytz.utc))
+        if not next_run_time:
+            return None
+
+        job = TimerJob(self, next(self._job_ids), func, trigger, next_run_time)
+        self._jobs[job.id] = job
+        self._push(job)
+
+        return job
+
+    def get_job(self, job_id: int) -> Optional[TimerJob]:
+        """Returns a scheduled job by its ID, or None if it is not scheduled"""
+        return self._jobs.get(job_id)
+
+    def remove_job(self, job_id: int):
+        """Unschedule a job by its ID"""
+        self._jobs.pop(job_id, None)
+
+        # Rebuild the heap if it mostly consists of removed jobs
+        if len(self._heap) > 2 * len(self._jobs) + 64:
+            self._heap = [entry for entry in self._heap if entry[1] in self._jobs]
+            heapq.heapify(self._heap)
+
+    def _push(self, job: TimerJob):
+        """Add a job to the heap, waking up earlier if necessary"""
+        run_timestamp = job.next_run_time.timestamp()
+        heapq.heappush(self._heap, (run_timestamp, job.id, job))
+
+        if self._wakeup_time is None or run_timestamp < self._wakeup_time:
+            self._schedule_wakeup()
+
+    def _schedule_wakeup(self):
+        """Sleep until the earliest job is due"""
+        if not self.running:
+            return
+
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+            self._wakeup_time = None
+
+        # Drop removed jobs from the top of the heap
+        while self._heap and self._heap[0][1] not in self._jobs:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            return
+
+        self._wakeup_time = self._heap[0][0]
+        delay = min(self._wakeup_time - time.time(), TIMER_HEAP_MAX_SLEEP)
+        self._wakeup = asyncio.get_event_loop().call_later(
+            max(delay, 0), self._run_due_jobs
+        )
+
+    def _run_due_jobs(self):
+        """Run all jobs that are due, then sleep until the next one is"""
+        self._wakeup = None
+        self._wakeup_time = None
+
+        now = datetime.now(tz=pytz.utc)
+        now_timestamp = now.timestamp()
+
+        while self._heap and self._heap[0][0] <= now_timestamp:
+            _, job_id, job = heapq.heappop(self._heap)
+            if job_id not in self._jobs:
+                # This job was removed
+                continue
+
+            # Work out when the job should run next, skipping any runs that were
+            # missed
+            due_time = next_run_time = job.next_run_time
+            while next_run_time and next_run_time <= now:
+                due_time = next_run_time
+                next_run_time = job.trigger.get_next_fire_time(next_run_time, now)
+            _due_times[job.id] = due_time.timestamp()
+
+            job.next_run_time = next_run_time
+            if next_run_time:
+                heapq.heappush(self._heap, (next_run_time.timestamp(), job.id, job))
+            else:
+                del self._jobs[job.id]
+
+            future = asyncio.ensure_future(self._run_job(job))
+            self._running_jobs.add(future)
+            future.add_done_callback(self._running_jobs.discard)
+
+        self._schedule_wakeup()
+
+    async def _run_job(self, job: TimerJob):
+        """Run a job, logging any exceptions it raises"""
+        try:
+            await job.func()
+        except Exception:
+            logger.exception("Job %s raised an exception", job.func)
+        finally:
+            _due_times.pop(job.id, None)
+
+
+# An alternative to SCHEDULER, used if configured
+TIMER_HEAP = TimerHeap()
+
+# When each job that is running was due to run, as a unix timestamp, by job ID.
+# Reminders take theirs out when they fire, and the entries of other jobs are removed
+# once they finish
+_due_times: Dict[Union[str, int], float] = {}
+
+
+def _record_due_time(event: JobSubmissionEvent):
+    """Note when a job that SCHEDULER is about to run was due to run"""
+    _due_times[event.job_id] = event.scheduled_run_times[-1].timestamp()
+
+
+def _forget_due_time(event: JobExecutionEvent):
+    """Forget when a job that SCHEDULER has finished running was due to run"""
+    _due_times.pop(event.job_id, None)
+
+
+SCHEDULER.add_listener(_record_due_time, EVENT_JOB_SUBMITTED)
+SCHEDULER.add_listener(_forget_due_time, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+
+# The job that periodically sounds ringing alarms, while there are any
+_alarm_ticker_job = None
+
+
+def get_scheduler() -> Union[AsyncIOScheduler, TimerHeap]:
+    """Returns the scheduler that reminders should be scheduled on, depending on the
+    value of the reminders.scheduler config option
+    """
+    if CONFIG.scheduler == "heap":
+        return TIMER_HEAP
+
+    return SCHEDULER
+
+
+@functools.lru_cache(maxsize=1024)
+def _build_cron_trigger(cron_tab: str, timezone: str) -> CronTrigger:
+    """Build a cron trigger. Cron triggers are large, and many reminders tend to share
+    the same cron tab, so reminders with the same cron tab and timezone share a trigger
+    """
+    return CronTrigger.from_crontab(cron_tab, timezone=timezone)
+
+
+def build_trigger(
+    timezone: str,
+    start_time: Optional[datetime] = None,
+    recurse_timedelta: Optional[timedelta] = None,
+    cron_tab: Optional[str] = None,
+) -> BaseTrigger:
+    """Build a trigger that determines when a reminder should fire
+
+    Args:
+        timezone: The database name of the timezone the reminder acts within
+        start_time: When the reminder should first go off. Required unless cron_tab
+            is given
+        recurse_timedelta: Optional. How often to repeat the reminder
+        cron_tab: Optional. A cron tab describing when to fire the reminder
+
+    Returns:
+        A cron trigger if a cron tab was given, an interval trigger if the reminder
+        recurs, otherwise a date trigger
+    """
+    # Determine how the reminder is triggered
+    if cron_tab:
+        # Set up a cron trigger
+        return _build_cron_trigger(cron_tab, timezone)
+
+    if recurse_timedelta:
+        # Use an interval trigger (runs multiple times)
+
+        # If the start_time of this reminder was in daylight savings for this timezone,
+        # and we are no longer in daylight savings, alter the start_time by the
+        # appropriate offset.
+        # TODO: Ideally this would be done dynamically instead of on reminder construction
+        tz = pytz.timezone(timezone)
+        start_time = tz.localize(start_time)
+        now = tz.localize(datetime.now())
+        if start_time.dst() != now.dst():
+            start_time += start_time.dst()
+
+        return IntervalTrigger(
+            # timedelta.seconds does NOT give you the timedelta converted to seconds
+            # Use a method from apscheduler instead
+            seconds=int(timedelta_seconds(recurse_timedelta)),
+            start_date=start_time,
+        )
+
+    # Use a date trigger (runs only once)
+    return DateTrigger(run_date=start_time, timezone=timezone)
+
+
+class SpreadTrigger(BaseTrigger):
+    """A trigger that fires a fixed amount of time after another trigger
+
+    Args:
+        trigger: The trigger to follow
+        offset: How long after the trigger to fire
+    """
+
+    __slots__ = ("trigger", "offset")
+
+    def __init__(self, trigger: BaseTrigger, offset: timedelta):
+        self.trigger = trigger
+        self.offset = offset
+
+    def get_next_fire_time(
+        self, previous_fire_time: Optional[datetime], now: datetime
+    ) -> Optional[datetime]:
+        # Ask the trigger being followed as if it were `offset` earlier
+        if previous_fire_time is not None:
+            previous_fire_time -= self.offset
+        next_fire_time = self.trigger.get_next_fire_time(
+            previous_fire_time, now - self.offset
+        )
+        return next_fire_time + self.offset if next_fire_time else None
+
+    def __str__(self) -> str:
+        return f"{self.trigger} + {self.offset}"
+
+
+def spread_offset(key: Tuple[str, str], spread: timedelta) -> timedelta:
+    """Work out how far to move a reminder's fire times within a spread window
+
+    The offset is a hash of the reminder's key, rather than random, so a reminder is
+    moved by the same amount every time the bot starts, and the time it's listed as
+    going off at is the time it really goes off.
+
+    Args:
+        key: The key of the reminder, a (room_id, upper-cased reminder text) tuple
+        spread: The size of the window
+
+    Returns:
+        A whole number of seconds, less than the size of the window
+    """
+    digest = zlib.crc32("\n".join(key).encode("utf-8"))
+    return timedelta(seconds=digest % int(spread.total_seconds()))
+
 
 class Reminder(object):
     """An object containing information about a reminder, when it should go off,
     whether it is recurring, etc.
 
+    The matrix client and storage that reminders use are shared, and held by REMINDERS.
+
     Args:
-        client: The matrix client
-        store: A Storage object
         room_id: The ID of the room the reminder should appear in
         start_time: When the reminder should first go off
         timezone: The database name of the timezone this reminder should act within
@@ -41,10 +423,25 @@ class Reminder(object):
             after they go off normally, until they are silenced.
     """
 
+    # There can be a great number of reminders in memory, so don't give each of them an
+    # instance dict
+    __slots__ = (
+        "room_id",
+        "timezone",
+        "start_time",
+        "reminder_text",
+        "key",
+        "cron_tab",
+        "recurse_timedelta",
+        "target_user",
+        "alarm",
+        "trigger",
+        "job",
+        "next_alarm_time",
+    )
+
     def __init__(
         self,
-        client: AsyncClient,
-        store,
         room_id: str,
         reminder_text: str,
         start_time: Optional[datetime] = None,
@@ -54,58 +451,136 @@ class Reminder(object):
         target_user: Optional[str] = None,
         alarm: bool = False,
     ):
-        self.client = client
-        self.store = store
-        self.room_id = room_id
-        self.timezone = timezone
+        # Room IDs, timezones and user IDs are shared by many reminders. Interning
+        # them means only one copy of each is kept in memory
+        self.room_id = sys.intern(room_id)
+        self.timezone = sys.intern(timezone) if timezone else None
         self.start_time = start_time
         self.reminder_text = reminder_text
         self.cron_tab = cron_tab
         self.recurse_timedelta = recurse_timedelta
-        self.target_user = target_user
+        self.target_user = sys.intern(target_user) if target_user else None
         self.alarm = alarm
 
-        # Schedule the reminder
-
-        # Determine how the reminder is triggered
-        if cron_tab:
-            # Set up a cron trigger
-            trigger = CronTrigger.from_crontab(cron_tab, timezone=timezone)
-        elif recurse_timedelta:
-            # Use an interval trigger (runs multiple times)
-
-            # If the start_time of this reminder was in daylight savings for this timezone,
-            # and we are no longer in daylight savings, alter the start_time by the
-            # appropriate offset.
-            # TODO: Ideally this would be done dynamically instead of on reminder construction
-            tz = pytz.timezone(timezone)
-            start_time = tz.localize(start_time)
-            now = tz.localize(datetime.now())
-            if start_time.dst() != now.dst():
-                start_time += start_time.dst()
-
-            trigger = IntervalTrigger(
-                # timedelta.seconds does NOT give you the timedelta converted to seconds
-                # Use a method from apscheduler instead
-                seconds=int(timedelta_seconds(recurse_timedelta)),
-                start_date=start_time,
+        # The key of this reminder in REMINDERS and ALARMS
+        self.key = (self.room_id, reminder_text.upper())
+
+        # Determine when the reminder should fire
+        self.trigger = build_trigger(timezone, start_time, recurse_timedelta, cron_tab)
+
+        # Move repeating reminders away from the times that many other reminders are
+        # likely to share
+        if CONFIG.spread and (recurse_timedelta or cron_tab):
+            self.trigger = SpreadTrigger(
+                self.trigger, spread_offset(self.key, CONFIG.spread)
             )
-        else:
-            # Use a date trigger (runs only once)
-            trigger = DateTrigger(run_date=start_time, timezone=timezone)
+
+        # The scheduler job of this reminder, which is only created once the reminder
+        # is due within the scheduling horizon
+        self.job = None
+        self.schedule()
+
+        # When a ringing alarm of this reminder should next sound, as a unix timestamp
+        self.next_alarm_time: Optional[float] = None
+
+    @property
+    def spread(self) -> Optional[timedelta]:
+        """How long after its scheduled times this reminder goes off, or None if it
+        isn't spread out
+        """
+        if isinstance(self.trigger, SpreadTrigger):
+            return self.trigger.offset
+        return None
+
+    def next_fire_time(self) -> Optional[datetime]:
+        """Returns when this reminder will next fire, or None if it won't fire again"""
+        return self.trigger.get_next_fire_time(None, datetime.now(tz=pytz.utc))
+
+    def _due_within_horizon(self) -> bool:
+        """Returns whether this reminder will fire within the scheduling horizon"""
+        if not CONFIG.schedule_horizon:
+            # Every reminder is kept scheduled
+            return True
+
+        next_fire_time = self.next_fire_time()
+        if not next_fire_time:
+            return False
+
+        return next_fire_time <= datetime.now(tz=pytz.utc) + CONFIG.schedule_horizon
+
+    def schedule(self):
+        """Add a job for this reminder to the scheduler, if it is due to fire within the
+        scheduling horizon and isn't already scheduled
+        """
+        if self.job or not self._due_within_horizon():
+            return
 
         # Note down the job for later manipulation
-        self.job = SCHEDULER.add_job(self._fire, trigger=trigger)
+        self.job = get_scheduler().add_job(self._fire, trigger=self.trigger)
+
+    def _unschedule(self):
+        """Remove the job of this reminder from the scheduler"""
+        if self.job and get_scheduler().get_job(self.job.id):
+            self.job.remove()
 
-        self.alarm_job = None
+        self.job = None
+
+    @property
+    def trigger_type(self) -> str:
+        """The kind of trigger that fires this reminder: "date", "interval" or "cron" """
+        if self.cron_tab:
+            return "cron"
+        if self.recurse_timedelta:
+            return "interval"
+        return "date"
+
+    def _measure_lateness(
+        self, kind: str, due_time: Optional[float]
+    ) -> Optional[Callable[[bool], None]]:
+        """Record how late a reminder or alarm has started being sent, and make a
+        callback that records how late it was sent
+
+        Args:
+            kind: Either "reminder" or "alarm"
+            due_time: When the reminder or alarm was due, as a unix timestamp. If
+                None, nothing is recorded
+
+        Returns:
+            A callback to pass as the on_done argument of send_text_to_room, or None
+        """
+        if due_time is None:
+            return None
+
+        FIRE_LATENESS.observe(time.time() - due_time, self.trigger_type, kind)
+
+        def on_done(sent: bool):
+            DELIVERY_LATENESS.observe(
+                time.time() - due_time,
+                self.trigger_type,
+                kind,
+                "sent" if sent else "failed",
+            )
+
+        return on_done
 
     async def _fire(self):
-        """Called when a reminder fires"""
+        """Called when a reminder fires. The reminder is sent along with any others
+        that fire at the same time
+        """
         logger.debug("Reminder in room %s fired: %s", self.room_id, self.reminder_text)
+        due_time = _due_times.pop(self.job.id, None) if self.job else None
+        FIRES.add(self, due_time)
+
+    async def _send(self, due_time: Optional[float] = None):
+        """Send a reminder that has fired
 
+        Args:
+            due_time: When the reminder was due to fire, as a unix timestamp
+        """
         # Build the reminder message
         target = self.target_user if self.target_user else "@room"
         message = f"{make_pill(target)} {self.reminder_text}"
+        digest_line = self.reminder_text
 
         # If this reminder has an alarm attached...
         if self.alarm:
@@ -114,30 +589,48 @@ class Reminder(object):
                 f"\n\n(This reminder has an alarm. You will be reminded again in 5m. "
                 f"Use the `{CONFIG.command_prefix}silence` command to stop)."
             )
+            digest_line += " (alarm, you will be reminded again in 5m)"
 
             # Check that an alarm is not already ongoing from a previous run
-            if not (self.room_id, self.reminder_text.upper()) in ALARMS:
+            if self.key not in ALARMS:
                 # Start alarming
-                self.alarm_job = SCHEDULER.add_job(
-                    self._fire_alarm,
-                    trigger=IntervalTrigger(
-                        # timedelta.seconds does NOT give you the timedelta converted to
-                        # seconds. Use a method from apscheduler instead
-                        seconds=int(timedelta_seconds(ALARM_TIMEDELTA)),
-                    ),
-                )
-                ALARMS[(self.room_id, self.reminder_text.upper())] = self.alarm_job
+                self.next_alarm_time = time.time() + ALARM_TIMEDELTA.total_seconds()
+                ALARMS[self.key] = self
+                _start_alarm_ticker()
 
         # Send the message to the room
-        await send_text_to_room(self.client, self.room_id, message, notice=False)
+        await DIGESTS.send(
+            DigestEntry(
+                self.room_id,
+                target,
+                message,
+                digest_line,
+                Priority.REMINDER,
+                self.alarm,
+                self._measure_lateness("reminder", due_time),
+            )
+        )
 
         # If this was a one-time reminder, cancel and remove from the reminders dict
         if not self.recurse_timedelta and not self.cron_tab:
             # We set cancel_alarm to False here else the associated alarms wouldn't even
             # fire
-            self.cancel(cancel_alarm=False)
+            await self.cancel(cancel_alarm=False)
+        else:
+            # Record when this reminder will next fire
+            await REMINDERS.store.update_next_fire_time(self)
+
+            # Free up the job if it won't be needed for a while. It will be scheduled
+            # again once the reminder is due within the scheduling horizon
+            if not self._due_within_horizon():
+                self._unschedule()
 
-    async def _fire_alarm(self):
+    async def _fire_alarm(self, due_time: Optional[float] = None):
+        """Sound a ringing alarm of this reminder
+
+        Args:
+            due_time: When the alarm was due to sound, as a unix timestamp
+        """
         logger.debug("Alarm in room %s fired: %s", self.room_id, self.reminder_text)
 
         # Build the alarm message
@@ -148,9 +641,19 @@ class Reminder(object):
         )
 
         # Send the message to the room
-        await send_text_to_room(self.client, self.room_id, message, notice=False)
+        await DIGESTS.send(
+            DigestEntry(
+                self.room_id,
+                target,
+                message,
+                f"Alarm: {self.reminder_text}",
+                Priority.ALARM,
+                True,
+                self._measure_lateness("alarm", due_time),
+            )
+        )
 
-    def cancel(self, cancel_alarm: bool = True):
+    async def cancel(self, cancel_alarm: bool = True):
         """Cancels a reminder and all recurring instances
 
         Args:
@@ -161,28 +664,404 @@ class Reminder(object):
         )
 
         # Remove from the in-memory reminder and alarm dicts
-        REMINDERS.pop((self.room_id, self.reminder_text.upper()), None)
-
-        # Delete the reminder from the database
-        self.store.delete_reminder(self.room_id, self.reminder_text)
+        REMINDERS.pop(self.key, None)
 
         # Delete any ongoing jobs
-        if self.job and SCHEDULER.get_job(self.job.id):
-            self.job.remove()
+        self._unschedule()
 
         # Cancel alarms of this reminder if required
         if cancel_alarm:
-            ALARMS.pop((self.room_id, self.reminder_text.upper()), None)
+            ALARMS.pop(self.key, None)
+
+        # Delete the reminder from the database. This is done last, so that the
+        # in-memory state is consistent while we wait on the database
+        await REMINDERS.store.delete_reminder(self.room_id, self.reminder_text)
+
+
+def _start_alarm_ticker():
+    """Start periodically sounding ringing alarms, if we aren't already"""
+    global _alarm_ticker_job
+
+    if _alarm_ticker_job:
+        return
+
+    _alarm_ticker_job = get_scheduler().add_job(
+        _sound_alarms,
+        trigger=IntervalTrigger(
+            # timedelta.seconds does NOT give you the timedelta converted to
+            # seconds. Use a method from apscheduler instead
+            seconds=int(timedelta_seconds(ALARM_TICK_INTERVAL)),
+        ),
+    )
+
+
+async def _sound_alarms():
+    """Sound all ringing alarms that are due, in a single pass
+
+    Stops the ticker once there are no more ringing alarms.
+    """
+    global _alarm_ticker_job
+
+    if not ALARMS:
+        # All alarms have been silenced
+        if _alarm_ticker_job and get_scheduler().get_job(_alarm_ticker_job.id):
+            _alarm_ticker_job.remove()
+        _alarm_ticker_job = None
+        return
+
+    now = time.time()
+    due_alarms = []
+    for reminder in ALARMS.values():
+        if reminder.next_alarm_time <= now:
+            due_alarms.append((reminder, reminder.next_alarm_time))
+            reminder.next_alarm_time += ALARM_TIMEDELTA.total_seconds()
+
+    await asyncio.gather(
+        *(reminder._fire_alarm(due_time) for reminder, due_time in due_alarms)
+    )
+
+
+class FireQueue(object):
+    def __init__(self):
+        """Collects reminders that fire at the same time, and sends them together
+
+        The scheduler starts the jobs of all the reminders that are due at once.
+        Reminders that fire in the same pass of the event loop are grouped by room,
+        and handed to the outbound queue room by room, in order of room ID. The
+        reminders in each room are queued one after another in order of their text,
+        so that the order that messages are sent in doesn't depend on the order that
+        the scheduler happened to fire them in. How many messages are sent at once is
+        limited by the outbound queue.
+        """
+        # Reminders that have fired, and when they were due to
+        self._fired: List[Tuple[Reminder, Optional[float]]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    def add(self, reminder: "Reminder", due_time: Optional[float] = None):
+        """Queue a reminder that has fired to be sent
+
+        Args:
+            reminder: The reminder
+            due_time: When the reminder was due to fire, as a unix timestamp
+        """
+        self._fired.append((reminder, due_time))
+        if self._flush_handle is None:
+            # Run after the jobs of the other reminders that are firing now
+            self._flush_handle = asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        fired, self._fired = self._fired, []
+        self._flush_handle = None
+        asyncio.ensure_future(self._send_batch(fired))
+
+    async def _send_batch(self, fired: List[Tuple["Reminder", Optional[float]]]):
+        # Group the reminders by room, in a deterministic order
+        rooms: Dict[str, List[Tuple[Reminder, Optional[float]]]] = {}
+        for reminder, due_time in sorted(fired, key=lambda entry: entry[0].key):
+            rooms.setdefault(reminder.room_id, []).append((reminder, due_time))
+
+        if len(fired) > 1:
+            logger.debug("Sending %d reminders to %d rooms", len(fired), len(rooms))
+
+        async def send_to_room(reminders: List[Tuple[Reminder, Optional[float]]]):
+            for reminder, due_time in reminders:
+                try:
+                    await reminder._send(due_time)
+                except Exception:
+                    logger.exception(
+                        "Unable to send reminder in room %s", reminder.room_id
+                    )
+
+        await asyncio.gather(*(send_to_room(reminders) for reminders in rooms.values()))
+
+
+FIRES = FireQueue()
+
+# A reminder or alarm message, and what's needed to include it in a digest
+DigestEntry = namedtuple(
+    "DigestEntry",
+    [
+        # The room the message is for
+        "room_id",
+        # The user ID, or "@room", that the message mentions
+        "target",
+        # The message to send if it isn't combined with any others
+        "message",
+        # The line that stands for the message in a digest
+        "line",
+        # The Priority to send the message with
+        "priority",
+        # Whether the message is about an alarm, which can be silenced
+        "alarm",
+        # Called with whether the message was sent, once it has been or has been
+        # given up on. May be None
+        "on_done",
+    ],
+)
+
+
+class DigestQueue(object):
+    def __init__(self):
+        """Combines the reminders and alarms that go off in a room within
+        `reminders.digest_window_seconds` of each other into a single message
+
+        Digests are only used in the rooms listed in `reminders.digest_rooms`, or in
+        every room if none are listed. The first message in a room starts the window,
+        and at the end of it everything collected for the room is sent as one
+        message, mentioning everyone that the individual messages would have. A
+        message that ends up on its own is sent unchanged.
+        """
+        self._pending: Dict[str, List[DigestEntry]] = {}
+        self._flush_handles: Dict[str, asyncio.Handle] = {}
 
-            if self.alarm_job and SCHEDULER.get_job(self.alarm_job.id):
-                self.alarm_job.remove()
+    def enabled_in(self, room_id: str) -> bool:
+        """Returns whether messages to a room are combined into digests"""
+        if not CONFIG.digest_window:
+            return False
+        return not CONFIG.digest_rooms or room_id in CONFIG.digest_rooms
 
+    async def send(self, entry: DigestEntry):
+        """Send a reminder or alarm message, or hold it back to be sent as part of a
+        digest if digests are used in its room
+        """
+        if not self.enabled_in(entry.room_id):
+            await send_text_to_room(
+                REMINDERS.client,
+                entry.room_id,
+                entry.message,
+                notice=False,
+                priority=entry.priority,
+                on_done=entry.on_done,
+            )
+            return
+
+        pending = self._pending.get(entry.room_id)
+        if pending is None:
+            pending = self._pending[entry.room_id] = []
+            self._flush_handles[entry.room_id] = asyncio.get_event_loop().call_later(
+                CONFIG.digest_window, self._flush, entry.room_id
+            )
+        pending.append(entry)
+
+    def _flush(self, room_id: str):
+        self._flush_handles.pop(room_id, None)
+        entries = self._pending.pop(room_id, None)
+        if entries:
+            asyncio.ensure_future(self._send_digest(room_id, entries))
+
+    async def flush_all(self):
+        """Send every digest now, without waiting for their windows to end"""
+        for handle in self._flush_handles.values():
+            handle.cancel()
+        self._flush_handles.clear()
+
+        pending, self._pending = self._pending, {}
+        for room_id, entries in pending.items():
+            await self._send_digest(room_id, entries)
+
+    async def _send_digest(self, room_id: str, entries: List[DigestEntry]):
+        callbacks = [entry.on_done for entry in entries if entry.on_done is not None]
+
+        def on_done(sent: bool):
+            for callback in callbacks:
+                callback(sent)
+
+        if len(entries) == 1:
+            message = entries[0].message
+        else:
+            logger.debug("Sending a digest of %d messages to %s", len(entries), room_id)
+
+            targets = dict.fromkeys(entry.target for entry in entries)
+            mentions = " ".join(make_pill(target) for target in targets)
+            lines = "\n".join(f"* {entry.line}" for entry in entries)
+            message = f"{mentions} {len(entries)} reminders:\n\n{lines}"
+            if any(entry.alarm for entry in entries):
+                message += (
+                    f"\n\n(Use `{CONFIG.command_prefix}silence [reminder text]` "
+                    f"to silence alarms)."
+                )
+
+        await send_text_to_room(
+            REMINDERS.client,
+            room_id,
+            message,
+            notice=False,
+            priority=min(entry.priority for entry in entries),
+            on_done=on_done if callbacks else None,
+        )
+
+
+DIGESTS = DigestQueue()
+
+# Whether encryption sessions are being prepared for upcoming reminders
+_prewarming = False
+
+
+def start_prewarming():
+    """Periodically prepare encryption sessions for rooms with reminders due soon, if
+    `reminders.prewarm_minutes` is set
+    """
+    if not CONFIG.prewarm_window:
+        return
+
+    get_scheduler().add_job(
+        prewarm_encryption,
+        trigger=IntervalTrigger(
+            # timedelta.seconds does NOT give you the timedelta converted to
+            # seconds. Use a method from apscheduler instead
+            seconds=int(timedelta_seconds(PREWARM_INTERVAL)),
+        ),
+    )
+
+
+async def prewarm_encryption():
+    """Share an outbound Megolm session in each encrypted room that a reminder or alarm
+    will go off in within `reminders.prewarm_minutes`, if the room doesn't have one
+
+    Without this, the first message sent to a room after its session has expired or
+    its members have changed has to wait for keys to be queried and claimed, and a new
+    session to be shared with every device in the room, which can take seconds in
+    large rooms. Doing that ahead of time means sending a reminder only needs it to be
+    encrypted.
+    """
+    global _prewarming
+
+    client = REMINDERS.client
+    if _prewarming or client is None or not client.olm or not client.logged_in:
+        return
+
+    _prewarming = True
+    try:
+        # Find the rooms with reminders due soon with a query on the indexed
+        # next_fire_at column, rather than looking through every reminder. Ringing
+        # alarms are few, so they're checked directly
+        now = datetime.now(tz=pytz.utc)
+        cutoff = now + CONFIG.prewarm_window
+        room_ids = set(await REMINDERS.store.get_rooms_with_reminders_due(now, cutoff))
+        alarm_cutoff = cutoff.timestamp()
+        room_ids.update(
+            reminder.room_id
+            for reminder in ALARMS.values()
+            if reminder.next_alarm_time <= alarm_cutoff
+        )
 
-# Global dictionaries
+        for room_id in sorted(room_ids):
+            room = client.rooms.get(room_id)
+            if (
+                room is None
+                or not room.encrypted
+                or not client.olm.should_share_group_session(room_id)
+            ):
+                continue
+
+            logger.debug("Sharing an encryption session in %s", room_id)
+            try:
+                # Make sure the session goes to every device in the room, as
+                # room_send would
+                if not room.members_synced:
+                    await client.joined_members(room_id)
+                    if client.should_query_keys:
+                        await client.keys_query()
+
+                # A message may have started sharing a session while we were waiting
+                if room_id in client.sharing_session:
+                    continue
+
+                await client.share_group_session(
+                    room_id, ignore_unverified_devices=True
+                )
+            except Exception:
+                # The session will be shared when the reminder is sent instead
+                logger.exception("Unable to share an encryption session in %s", room_id)
+    finally:
+        _prewarming = False
+
+
+class ReminderRegistry(object):
+    """A dict-like collection of reminders, keyed by (room_id, reminder_text) tuples
+
+    In addition to the main mapping, reminders are indexed by the room they belong to,
+    so that looking up the reminders of a single room doesn't require going through
+    every reminder.
+    """
+
+    def __init__(self):
+        # The matrix client and Storage object used by reminders in this registry
+        self.client: Optional[AsyncClient] = None
+        self.store = None
+
+        self._reminders: Dict[Tuple[str, str], Reminder] = {}
+        self._by_room: Dict[str, Dict[Tuple[str, str], Reminder]] = {}
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self._reminders
+
+    def __getitem__(self, key: Tuple[str, str]) -> Reminder:
+        return self._reminders[key]
+
+    def __setitem__(self, key: Tuple[str, str], reminder: Reminder):
+        # Remove any existing reminder with this key from the indexes
+        self.pop(key)
+
+        self._reminders[key] = reminder
+        self._by_room.setdefault(reminder.room_id, {})[key] = reminder
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return iter(self._reminders)
+
+    def __len__(self) -> int:
+        return len(self._reminders)
+
+    def __repr__(self) -> str:
+        return repr(self._reminders)
+
+    def get(
+        self, key: Tuple[str, str], default: Optional[Reminder] = None
+    ) -> Optional[Reminder]:
+        return self._reminders.get(key, default)
+
+    def pop(
+        self, key: Tuple[str, str], default: Optional[Reminder] = None
+    ) -> Optional[Reminder]:
+        """Remove a reminder by its key, returning it if it was present"""
+        reminder = self._reminders.pop(key, None)
+        if not reminder:
+            return default
+
+        self._remove_from_index(self._by_room, reminder.room_id, key)
+
+        return reminder
+
+    def values(self) -> ValuesView[Reminder]:
+        return self._reminders.values()
+
+    def in_room(self, room_id: str) -> ValuesView[Reminder]:
+        """Returns all reminders in a room"""
+        return self._by_room.get(room_id, {}).values()
+
+    @staticmethod
+    def _remove_from_index(
+        index: Dict[str, Dict[Tuple[str, str], Reminder]],
+        index_key: str,
+        key: Tuple[str, str],
+    ):
+        """Remove a reminder from a secondary index, dropping empty entries"""
+        reminders = index.get(index_key)
+        if reminders is None:
+            return
+
+        reminders.pop(key, None)
+        if not reminders:
+            del index[index_key]
+
+
+# Global reminder registries
 #
 # Both feature (room_id, reminder_text) tuples as keys
 #
 # reminder_text should be accessed and stored as uppercase in order to
 # allow for case-insensitive matching when carrying out user actions
-REMINDERS: Dict[Tuple[str, str], Reminder] = {}
-ALARMS: Dict[Tuple[str, str], Job] = {}
+REMINDERS = ReminderRegistry()
+
+# Reminders whose alarms are currently ringing. Silencing an alarm removes it from here
+ALARMS = ReminderRegistry()
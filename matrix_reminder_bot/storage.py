@@ -1,36 +1,129 @@
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Tuple
+from typing import Any, Callable, List, Optional, Tuple
 
 import pytz
+from apscheduler.triggers.interval import IntervalTrigger
 from apscheduler.util import timedelta_seconds
 from nio import AsyncClient
 
 from matrix_reminder_bot.config import CONFIG
-from matrix_reminder_bot.reminder import REMINDERS, Reminder
+from matrix_reminder_bot.reminder import (
+    REMINDERS,
+    Reminder,
+    build_trigger,
+    get_scheduler,
+)
 
-latest_migration_version = 3
+latest_migration_version = 4
+
+# The number of reminder rows to read from the database at a time on startup
+LOAD_BATCH_SIZE = 500
+
+# The number of queued writes after which callers wait for the queue to be flushed,
+# rather than letting it grow further
+MAX_PENDING_WRITES = 1000
 
 logger = logging.getLogger(__name__)
 
 
+def format_utc(time: Optional[datetime]) -> Optional[str]:
+    """Format a timezone-aware datetime for storage in a next_fire_at column
+
+    Times are converted to UTC and formatted with a fixed width, so that comparing the
+    strings compares the times they represent.
+    """
+    if not time:
+        return None
+
+    return time.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
 class Storage(object):
     def __init__(self, client: AsyncClient):
-        """Setup the database
+        """Bot storage, backed by either SQLite or Postgres
 
-        Runs an initial setup or migrations depending on whether a database file has already
-        been created
+        All database access happens on a single dedicated thread, so that slow disks or
+        remote databases never block the event loop. Call `setup` before using the
+        store.
 
         Args:
             client: The matrix client
         """
-        # Check which type of database has been configured
         self.client = client
+        self.db_type = CONFIG.database.type
+        self.conn = None
+        self.cursor = None
+
+        # A single worker ensures that statements run in the order they were submitted,
+        # and that the connection is only ever used from the thread that created it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+        # Reminder inserts and deletes are queued here and written to the database in
+        # a single transaction once CONFIG.database.max_write_delay has passed
+        self._pending_writes: List[Tuple[str, tuple]] = []
+        self._flush_task: Optional[asyncio.Future] = None
+
+    async def setup(self):
+        """Setup the database and load stored reminders
+
+        Runs an initial setup or migrations depending on whether a database file has already
+        been created
+        """
+        # Reminders use this client and store
+        REMINDERS.client = self.client
+        REMINDERS.store = self
+
+        await self._run(self._setup_database)
+
+        # One-off reminders that should have fired while we were offline will never
+        # fire. Remove them before loading the rest
+        missed_count = await self._run(self._purge_missed_reminders)
+        if missed_count:
+            logger.info("Deleted %d missed one-off reminders", missed_count)
+
+        # Load reminders from the db
+        reminder_count = await self._load_reminders()
+
+        logger.info(
+            f"Database initialization of type '{self.db_type}' complete. "
+            f"Loaded {reminder_count} reminders"
+        )
+
+        if CONFIG.schedule_horizon:
+            # Reminders only get scheduled once they're due within the horizon. Check
+            # for newly due reminders twice per horizon, so that every reminder is
+            # scheduled well before it fires
+            get_scheduler().add_job(
+                self._schedule_upcoming_reminders,
+                trigger=IntervalTrigger(
+                    seconds=timedelta_seconds(CONFIG.schedule_horizon) / 2
+                ),
+            )
+
+    async def close(self):
+        """Write any queued changes, then close the database connection"""
+        await self.flush()
+        await self._run(self.conn.close)
+        self._executor.shutdown()
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """Run a blocking function on the database thread and wait for its result"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _setup_database(self):
+        """Connect to the database and bring its schema up to date
+
+        Must be run on the database thread.
+        """
+        # Check which type of database has been configured
         self.conn = self._get_database_connection(
-            CONFIG.database.type, CONFIG.database.connection_string
+            self.db_type, CONFIG.database.connection_string
         )
         self.cursor = self.conn.cursor()
-        self.db_type = CONFIG.database.type
 
         # Try to check the current migration version
         migration_level = 0
@@ -44,11 +137,6 @@ class Storage(object):
             if migration_level < latest_migration_version:
                 self._run_db_migrations(migration_level)
 
-        # Load reminders from the db
-        REMINDERS.update(self._load_reminders())
-
-        logger.info(f"Database initialization of type '{self.db_type}' complete")
-
     def _get_database_connection(self, database_type: str, connection_string: str):
         if database_type == "sqlite":
             import sqlite3
@@ -72,6 +160,66 @@ class Storage(object):
         else:
             self.cursor.execute(*args)
 
+    def _queue_write(self, *args):
+        """Queue a write to the database. Writes are committed in order, in batches
+
+        Args:
+            args: Arguments to pass to `_execute`
+        """
+        self._pending_writes.append(args)
+
+        # Start a flush timer if one isn't already counting down
+        if not self._flush_task or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_after_delay())
+
+    async def _flush_after_delay(self):
+        """Wait for more writes to arrive, then commit all of them"""
+        await asyncio.sleep(CONFIG.database.max_write_delay)
+        await self.flush()
+
+    async def _wait_for_queue_space(self):
+        """Commit queued writes if the queue has grown too large"""
+        if len(self._pending_writes) >= MAX_PENDING_WRITES:
+            await self.flush()
+
+    async def flush(self):
+        """Commit all queued writes to the database in a single transaction"""
+        if not self._pending_writes:
+            return
+
+        writes, self._pending_writes = self._pending_writes, []
+        await self._run(self._commit_writes, writes)
+
+    def _commit_writes(self, writes: List[Tuple[str, tuple]]):
+        """Execute a batch of writes inside a single transaction
+
+        If the transaction fails, each write is retried on its own so that a single bad
+        write does not cause the rest of the batch to be lost.
+
+        Must be run on the database thread.
+        """
+        logger.debug("Committing %d queued database writes", len(writes))
+
+        try:
+            self._execute("BEGIN")
+            for write in writes:
+                self._execute(*write)
+            self._execute("COMMIT")
+            return
+        except Exception:
+            logger.exception("Failed to commit batch of writes. Retrying individually")
+            try:
+                self._execute("ROLLBACK")
+            except Exception:
+                # The transaction may never have started
+                pass
+
+        for write in writes:
+            try:
+                self._execute(*write)
+            except Exception:
+                logger.exception("Unable to write to the database: %s", write)
+
     def _initial_db_setup(self):
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
@@ -271,14 +419,168 @@ class Storage(object):
 
             logger.info("Database migrated to v3")
 
-    def _load_reminders(self) -> Dict[Tuple[str, str], Reminder]:
-        """Load reminders from the database
+        if current_migration_version < 4:
+            logger.info("Migrating the database from v3 to v4...")
+
+            # Add a column recording when each reminder will next fire, in UTC. This
+            # allows us to query for reminders that are due within a time range
+            self._execute(
+                """
+                ALTER TABLE reminder
+                    ADD COLUMN next_fire_at TEXT
+            """
+            )
+            self._execute(
+                """
+                CREATE INDEX reminder_next_fire_at
+                ON reminder(next_fire_at)
+            """
+            )
+
+            # Calculate the next fire time of all existing reminders
+            self._execute(
+                """
+                SELECT text, room_id, start_time, timezone, recurse_timedelta_s, cron_tab
+                FROM reminder
+            """
+            )
+            rows = self.cursor.fetchall()
+
+            now = datetime.now(tz=pytz.utc)
+            self._execute("BEGIN")
+            for row in rows:
+                trigger = build_trigger(
+                    row[3],
+                    start_time=datetime.fromisoformat(row[2]) if row[2] else None,
+                    recurse_timedelta=timedelta(seconds=row[4]) if row[4] else None,
+                    cron_tab=row[5],
+                )
+                next_fire_at = format_utc(trigger.get_next_fire_time(None, now))
+
+                self._execute(
+                    """
+                    UPDATE reminder SET next_fire_at = ?
+                        WHERE text = ? AND room_id = ?
+                """,
+                    (next_fire_at, row[0], row[1]),
+                )
+            self._execute("COMMIT")
+
+            self._execute(
+                """
+                 UPDATE migration_version SET version = 4
+            """
+            )
+
+            logger.info("Database migrated to v4")
+
+    async def _load_reminders(self) -> int:
+        """Load reminders from the database and schedule them
+
+        Rows are streamed from the database in batches of LOAD_BATCH_SIZE, with each
+        batch being turned into Reminders before the next is fetched. This keeps memory
+        use flat no matter how many reminders are stored.
+
+        Returns:
+            The number of reminders that were loaded
+        """
+        cursor = await self._run(self._open_load_cursor)
+        reminder_count = 0
+
+        try:
+            while True:
+                rows = await self._run(cursor.fetchmany, LOAD_BATCH_SIZE)
+                if not rows:
+                    break
+
+                reminder_count += self._load_reminder_rows(rows)
+        finally:
+            await self._run(cursor.close)
+
+        return reminder_count
+
+    def _purge_missed_reminders(self) -> int:
+        """Delete all one-off reminders whose fire time is in the past
+
+        Must be run on the database thread.
+
+        Returns:
+            The number of reminders that were deleted
+        """
+        self._execute(
+            """
+            DELETE FROM reminder
+                WHERE next_fire_at < ?
+                AND recurse_timedelta_s IS NULL
+                AND cron_tab IS NULL
+        """,
+            (format_utc(datetime.now(tz=pytz.utc)),),
+        )
+
+        return self.cursor.rowcount
+
+    async def _schedule_upcoming_reminders(self):
+        """Schedule all reminders that will fire within the scheduling horizon"""
+        # Ensure the fire times we're about to read are up to date
+        await self.flush()
+
+        horizon_end = datetime.now(tz=pytz.utc) + CONFIG.schedule_horizon
+        rows = await self._run(self._select_reminders_due_before, horizon_end)
+        logger.debug("Found %d reminders due within the scheduling horizon", len(rows))
+
+        for room_id, reminder_text in rows:
+            reminder = REMINDERS.get((room_id, reminder_text.upper()))
+            if reminder:
+                reminder.schedule()
+
+    def _select_reminders_due_before(self, time: datetime) -> List[Tuple[str, str]]:
+        """Find the reminders that will next fire before a given time
+
+        Must be run on the database thread.
+
+        Returns:
+            A list of (room_id, reminder text) tuples
+        """
+        self._execute(
+            """
+            SELECT room_id, text FROM reminder WHERE next_fire_at <= ?
+        """,
+            (format_utc(time),),
+        )
+        return self.cursor.fetchall()
+
+    async def get_rooms_with_reminders_due(
+        self, start: datetime, end: datetime
+    ) -> List[str]:
+        """Find the rooms that have reminders which will next fire between two times
 
         Returns:
-            A dictionary from (room_id, reminder text) to Reminder object
+            The IDs of the rooms
         """
+        return await self._run(self._select_rooms_with_reminders_due, start, end)
+
+    def _select_rooms_with_reminders_due(
+        self, start: datetime, end: datetime
+    ) -> List[str]:
+        """Must be run on the database thread"""
         self._execute(
             """
+            SELECT DISTINCT room_id FROM reminder
+                WHERE next_fire_at >= ? AND next_fire_at <= ?
+        """,
+            (format_utc(start), format_utc(end)),
+        )
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def _open_load_cursor(self):
+        """Open a cursor over every reminder in the database
+
+        For Postgres this is a server-side cursor, so rows are only sent to us as they
+        are fetched. SQLite cursors already step through results lazily.
+
+        Must be run on the database thread.
+        """
+        query = """
             SELECT
                 text,
                 start_time,
@@ -290,10 +592,29 @@ class Storage(object):
                 alarm
             FROM reminder
         """
-        )
-        rows = self.cursor.fetchall()
-        logger.debug("Loaded reminder rows: %s", rows)
-        reminders = {}
+
+        if self.db_type == "postgres":
+            # withhold allows the cursor to outlive the transaction it was created in,
+            # which is necessary as we're in autocommit mode
+            cursor = self.conn.cursor(name="load_reminders", withhold=True)
+            cursor.itersize = LOAD_BATCH_SIZE
+        else:
+            cursor = self.conn.cursor()
+
+        cursor.execute(query)
+        return cursor
+
+    def _load_reminder_rows(self, rows: List[tuple]) -> int:
+        """Create and schedule Reminders from a batch of reminder rows
+
+        Args:
+            rows: Rows from the reminder table, as selected by `_open_load_cursor`
+
+        Returns:
+            The number of reminders that were loaded
+        """
+        logger.debug("Loading a batch of %d reminder rows", len(rows))
+        reminder_count = 0
 
         for row in rows:
             # Extract reminder data
@@ -306,30 +627,8 @@ class Storage(object):
             target_user = row[6]
             alarm = row[7]
 
-            if start_time:
-                # If this is a one-off reminder whose start time is in the past, then it will
-                # never fire. Ignore and delete the row from the db
-                if not recurse_timedelta and not cron_tab:
-                    now = datetime.now(tz=pytz.timezone(timezone))
-
-                    # We don't replace the timezone in start_time itself as Reminder.__init__
-                    # will add the timezone later (and doing so twice will produce strange
-                    # behaviour)
-                    if start_time.replace(tzinfo=pytz.timezone(timezone)) < now:
-                        logger.debug(
-                            "Deleting missed reminder in room %s: %s - %s",
-                            room_id,
-                            reminder_text,
-                            start_time,
-                        )
-
-                        self.delete_reminder(room_id, reminder_text)
-                        continue
-
             # Create and record the reminder
-            reminders[(room_id, reminder_text.upper())] = Reminder(
-                client=self.client,
-                store=self,
+            reminder = Reminder(
                 reminder_text=reminder_text,
                 start_time=start_time,
                 timezone=timezone,
@@ -339,10 +638,12 @@ class Storage(object):
                 target_user=target_user,
                 alarm=alarm,
             )
+            REMINDERS[reminder.key] = reminder
+            reminder_count += 1
 
-        return reminders
+        return reminder_count
 
-    def store_reminder(self, reminder: Reminder):
+    async def store_reminder(self, reminder: Reminder):
         """Store a new reminder in the database"""
         # timedelta.seconds does NOT give you the timedelta converted to seconds
         # Use a method from apscheduler instead
@@ -356,7 +657,8 @@ class Storage(object):
             # in the database
             reminder.start_time = reminder.start_time.replace(tzinfo=None)
 
-        self._execute(
+        await self._wait_for_queue_space()
+        self._queue_write(
             """
             INSERT INTO reminder (
                 text,
@@ -366,9 +668,10 @@ class Storage(object):
                 cron_tab,
                 room_id,
                 target_user,
-                alarm
+                alarm,
+                next_fire_at
             ) VALUES (
-                ?, ?, ?, ?, ?, ?, ?, ?
+                ?, ?, ?, ?, ?, ?, ?, ?, ?
             )
         """,
             (
@@ -380,12 +683,28 @@ class Storage(object):
                 reminder.room_id,
                 reminder.target_user,
                 reminder.alarm,
+                format_utc(reminder.next_fire_time()),
             ),
         )
 
-    def delete_reminder(self, room_id: str, reminder_text: str):
+    async def update_next_fire_time(self, reminder: Reminder):
+        """Record when a recurring reminder will next fire"""
+        await self._wait_for_queue_space()
+        self._queue_write(
+            """
+            UPDATE reminder SET next_fire_at = ? WHERE room_id = ? AND text = ?
+        """,
+            (
+                format_utc(reminder.next_fire_time()),
+                reminder.room_id,
+                reminder.reminder_text,
+            ),
+        )
+
+    async def delete_reminder(self, room_id: str, reminder_text: str):
         """Delete a reminder via its reminder text and the room it was sent in"""
-        self._execute(
+        await self._wait_for_queue_space()
+        self._queue_write(
             """
             DELETE FROM reminder WHERE room_id = ? AND text = ?
         """,
@@ -0,0 +1,431 @@
+import logging
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, time, timedelta
+from typing import Any, Optional, Tuple
+
+import pytz
+
+from matrix_reminder_bot import metrics
+from matrix_reminder_bot.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# The maximum number of time expressions to remember the meaning of
+PARSE_CACHE_SIZE = 1024
+
+# Common time expressions that can be parsed without dateparser
+_UNIT = r"(seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|weeks?)"
+_UNIT_NAMES = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+_TIME_OF_DAY = r"(\d{1,2})(?::(\d{2}))?(?::(\d{2}))? ?(am|pm)?"
+_INTERVAL_RE = re.compile(r"(\d{1,6}) ?" + _UNIT)
+_RELATIVE_RE = re.compile(r"(?:in )?(\d{1,6}) ?" + _UNIT)
+_TIME_OF_DAY_RE = re.compile(_TIME_OF_DAY)
+_TOMORROW_RE = re.compile(r"tomorrow (?:at )?" + _TIME_OF_DAY)
+_ISO_8601_RE = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})"
+    r"(?:[t ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?(z|[+-]\d{2}:\d{2})?)?"
+)
+
+# Options passed through to dateparser. languages and locales are tuples of the
+# languages and locales to try, and date_order is the order to read ambiguous dates
+# such as 01/02/03 in, e.g. "DMY". None means to use dateparser's default
+ParserOptions = namedtuple(
+    "ParserOptions", ["languages", "locales", "date_order"], defaults=(None, None, None)
+)
+
+# Expressions parsed to load dateparser's language data ahead of the first command
+WARM_UP_EXPRESSIONS = [
+    "in 5 minutes",
+    "tomorrow at 9am",
+    "next monday at 5pm",
+    "december 25 at 10:30",
+    "01/02/2030",
+]
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# Counted by the caller of parse_cached rather than by the cache itself, as with a
+# process pool each worker process has its own cache
+PARSE_CACHE_LOOKUPS = metrics.counter(
+    "time_parse_cache_lookups_total",
+    "Time expressions that needed dateparser, by whether the parse cache knew them",
+    ["result"],
+)
+
+# The kinds of entry the cache can hold
+_ABSOLUTE = 0  # A fixed wall-clock time
+_RELATIVE = 1  # An offset from the time of parsing
+_UNCACHEABLE = 2  # Neither of the above, so it must be parsed every time
+
+
+class _CacheEntry(object):
+    __slots__ = ("kind", "value", "day")
+
+    def __init__(self, kind: int, value: Any, day: date):
+        self.kind = kind
+        self.value = value
+        # The local date this entry was parsed on. Expressions such as "9am" or
+        # "monday" mean something different on another day, so entries are only
+        # used on the day they were created
+        self.day = day
+
+
+class TimeParseCache(object):
+    def __init__(self, maxsize: int = PARSE_CACHE_SIZE):
+        """A bounded LRU cache of parsed, human-readable time expressions
+
+        dateparser is slow, and people tend to use the same few phrases over and over.
+        To find out what kind of result to store, a new expression is parsed relative
+        to two different times: now, and the end of the day. If both give the same
+        result, the expression names a fixed wall-clock time ("tomorrow at 9am") and
+        that time is stored. If the results are as far apart as the two base times,
+        the expression is relative ("in 10 minutes") and the offset is stored, so that
+        it gives the right answer however much later it is looked up.
+
+        Args:
+            maxsize: The maximum number of expressions to remember
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str, bool, ParserOptions], _CacheEntry]" = (
+            OrderedDict()
+        )
+        # The cache may be used from several worker threads at once
+        self._lock = threading.Lock()
+
+    def parse(
+        self,
+        time_str: str,
+        timezone: str,
+        tz_aware: bool,
+        options: ParserOptions = ParserOptions(),
+    ) -> Optional[datetime]:
+        """Parses a human-readable, future time string, using the cache where possible
+
+        Args:
+            time_str: The time to parse
+            timezone: The timezone that time_str is written in
+            tz_aware: Whether the returned datetime should have associated timezone
+                information
+            options: Options to pass through to dateparser
+
+        Returns:
+            The parsed datetime, or None if time_str could not be parsed
+        """
+        result, _ = self.lookup(time_str, timezone, tz_aware, options)
+        return result
+
+    def lookup(
+        self,
+        time_str: str,
+        timezone: str,
+        tz_aware: bool,
+        options: ParserOptions = ParserOptions(),
+    ) -> Tuple[Optional[datetime], bool]:
+        """Like parse, but also returns whether the result came from the cache"""
+        tzinfo = pytz.timezone(timezone)
+
+        # dateparser interprets a naive relative base as local time in `timezone`
+        aware_now = datetime.now(tzinfo)
+        now = aware_now.replace(tzinfo=None)
+
+        key = (" ".join(time_str.lower().split()), timezone, tz_aware, options)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.day == now.date():
+                self._entries.move_to_end(key)
+                if entry.kind != _UNCACHEABLE:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if entry is not None:
+            if entry.kind == _ABSOLUTE:
+                return entry.value, True
+            if entry.kind == _RELATIVE:
+                result = now + entry.value
+                if tz_aware:
+                    # Like dateparser, keep the UTC offset that is in effect now
+                    result = result.replace(tzinfo=aware_now.tzinfo)
+                return result, True
+
+            return _parse(time_str, timezone, tz_aware, now, options), False
+
+        result = _parse(time_str, timezone, tz_aware, now, options)
+
+        # Parse again relative to the end of the day to find out what kind of
+        # expression this is
+        end_of_day = datetime.combine(now.date(), time(23, 59, 59))
+        if result is None:
+            # Expressions that can't be parsed now won't be any easier later in the
+            # day. Parsing them is slowest of all, so don't try twice
+            entry = _CacheEntry(_ABSOLUTE, None, now.date())
+        elif end_of_day <= now:
+            # Too close to midnight to tell
+            entry = _CacheEntry(_UNCACHEABLE, None, now.date())
+        else:
+            later_result = _parse(time_str, timezone, tz_aware, end_of_day, options)
+            if later_result == result:
+                entry = _CacheEntry(_ABSOLUTE, result, now.date())
+            elif later_result is not None and later_result - result == end_of_day - now:
+                entry = _CacheEntry(
+                    _RELATIVE, result.replace(tzinfo=None) - now, now.date()
+                )
+            else:
+                entry = _CacheEntry(_UNCACHEABLE, None, now.date())
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return result, False
+
+    def cache_info(self) -> CacheInfo:
+        """Returns the cache's statistics, in the style of functools.lru_cache"""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def cache_clear(self):
+        """Forgets all cached expressions and resets the statistics"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def _parse(
+    time_str: str,
+    timezone: str,
+    tz_aware: bool,
+    relative_base: datetime,
+    options: ParserOptions,
+) -> Optional[datetime]:
+    """Parses a time string with dateparser relative to a given local time"""
+    # dateparser takes a while to import, so only do so once it's needed
+    import dateparser
+
+    settings = {
+        "PREFER_DATES_FROM": "future",
+        "TIMEZONE": timezone,
+        "RETURN_AS_TIMEZONE_AWARE": tz_aware,
+        "RELATIVE_BASE": relative_base,
+    }
+    if options.date_order:
+        settings["DATE_ORDER"] = options.date_order
+
+    return dateparser.parse(
+        time_str,
+        languages=list(options.languages) if options.languages else None,
+        locales=list(options.locales) if options.locales else None,
+        settings=settings,
+    )
+
+
+TIME_PARSE_CACHE = TimeParseCache()
+
+
+def _unit_timedelta(amount: str, unit: str) -> timedelta:
+    """Converts a number and one of the units matched by _UNIT to a timedelta"""
+    return timedelta(**{_UNIT_NAMES[unit[0]]: int(amount)})
+
+
+def _time_of_day(
+    hour: str, minute: Optional[str], second: Optional[str], meridiem: Optional[str]
+) -> time:
+    """Builds a time from the groups matched by _TIME_OF_DAY
+
+    Raises:
+        ValueError: if the groups do not make up a valid time
+    """
+    if minute is None and meridiem is None:
+        # A bare number isn't a time
+        raise ValueError("Not a time of day")
+
+    hour = int(hour)
+    if meridiem:
+        if not 1 <= hour <= 12:
+            raise ValueError("Hour out of range")
+        hour = hour % 12 + (12 if meridiem == "pm" else 0)
+
+    return time(hour, int(minute or 0), int(second or 0))
+
+
+def parse_fast(
+    time_str: str, tzinfo: pytz.BaseTzInfo, tz_aware: bool, now: datetime
+) -> Optional[datetime]:
+    """Parses the most common forms of time expression without dateparser
+
+    Handles "in N <units>", "HH:MM", "tomorrow at HH:MM" and ISO 8601 timestamps, with
+    the same results as dateparser.
+
+    Args:
+        time_str: The time to parse
+        tzinfo: The timezone that time_str is written in
+        tz_aware: Whether the returned datetime should have associated timezone
+            information
+        now: The current time in tzinfo
+
+    Returns:
+        The parsed datetime, or None if time_str isn't in one of the handled forms
+    """
+    time_str = " ".join(time_str.lower().split())
+    now_offset = now.tzinfo
+    now = now.replace(tzinfo=None)
+
+    # Whether the result was worked out from the current date and time
+    from_now = False
+
+    try:
+        match = _RELATIVE_RE.fullmatch(time_str)
+        if match:
+            result = now + _unit_timedelta(*match.groups())
+            from_now = True
+
+        elif _TIME_OF_DAY_RE.fullmatch(time_str):
+            # The next time the clock shows this time
+            time_of_day = _time_of_day(*_TIME_OF_DAY_RE.fullmatch(time_str).groups())
+            result = datetime.combine(now.date(), time_of_day)
+            if result < now:
+                result += timedelta(days=1)
+
+        elif _TOMORROW_RE.fullmatch(time_str):
+            time_of_day = _time_of_day(*_TOMORROW_RE.fullmatch(time_str).groups())
+            result = datetime.combine(now.date() + timedelta(days=1), time_of_day)
+            from_now = True
+
+        elif _ISO_8601_RE.fullmatch(time_str):
+            groups = _ISO_8601_RE.fullmatch(time_str).groups()
+            year, month, day, hour, minute, second, fraction, offset = groups
+            result = datetime(
+                int(year),
+                int(month),
+                int(day),
+                int(hour or 0),
+                int(minute or 0),
+                int(second or 0),
+                int((fraction or "0").ljust(6, "0")),
+            )
+            if offset:
+                # Convert to local time in the target timezone
+                if offset == "z":
+                    offset_delta = timedelta(0)
+                else:
+                    sign = -1 if offset[0] == "-" else 1
+                    offset_delta = sign * timedelta(
+                        hours=int(offset[1:3]), minutes=int(offset[4:6])
+                    )
+                result = (
+                    pytz.utc.localize(result - offset_delta)
+                    .astimezone(tzinfo)
+                    .replace(tzinfo=None)
+                )
+
+        else:
+            return None
+    except (ValueError, OverflowError):
+        # Leave anything out of range to dateparser
+        return None
+
+    if not tz_aware:
+        return result
+    if from_now:
+        # Like dateparser, keep the UTC offset that is in effect now
+        return result.replace(tzinfo=now_offset)
+    return tzinfo.localize(result)
+
+
+def parse_interval(time_str: str) -> Optional[timedelta]:
+    """Parses a simple "N <units>" interval, such as the "1 week" in "every 1 week"
+
+    Returns:
+        The parsed timedelta, or None if time_str isn't a simple, non-zero interval
+    """
+    match = _INTERVAL_RE.fullmatch(" ".join(time_str.lower().split()))
+    if not match:
+        return None
+
+    try:
+        return _unit_timedelta(*match.groups()) or None
+    except OverflowError:
+        return None
+
+
+def parser_options() -> ParserOptions:
+    """Returns the dateparser options set in the bot's config"""
+    return ParserOptions(
+        CONFIG.parsing.languages, CONFIG.parsing.locales, CONFIG.parsing.date_order
+    )
+
+
+def parse_cached(
+    time_str: str,
+    timezone: str,
+    tz_aware: bool = True,
+    options: ParserOptions = ParserOptions(),
+) -> Tuple[Optional[datetime], bool]:
+    """Parses a human-readable, future time string to a datetime with dateparser,
+    using the cache where possible
+
+    This is TIME_PARSE_CACHE.lookup as a plain function, so that it can be run in a
+    process pool. The arguments are the same as parse_time's.
+
+    Returns:
+        The parsed datetime, or None if time_str could not be parsed, and whether it
+        came from the cache
+    """
+    return TIME_PARSE_CACHE.lookup(time_str, timezone, tz_aware, options)
+
+
+def parse_time(
+    time_str: str,
+    timezone: str,
+    tz_aware: bool = True,
+    options: ParserOptions = ParserOptions(),
+) -> Optional[datetime]:
+    """Parses a human-readable, future time string to a datetime
+
+    Common forms of expression are parsed directly, and anything else goes through
+    dateparser.
+
+    Args:
+        time_str: The time to parse
+        timezone: The timezone that time_str is written in
+        tz_aware: Whether the returned datetime should have associated timezone
+            information
+        options: Options to pass through to dateparser
+
+    Returns:
+        The parsed datetime, or None if time_str could not be parsed
+    """
+    tzinfo = pytz.timezone(timezone)
+    result = parse_fast(time_str, tzinfo, tz_aware, datetime.now(tzinfo))
+    if result is not None:
+        return result
+
+    return TIME_PARSE_CACHE.parse(time_str, timezone, tz_aware, options)
+
+
+def warm_up(timezone: str, options: ParserOptions = ParserOptions()):
+    """Loads dateparser's language data, which it otherwise does on the first parse
+
+    Args:
+        timezone: The timezone that times will be parsed in
+        options: Options that will be passed through to dateparser
+    """
+    tzinfo = pytz.timezone(timezone)
+    now = datetime.now(tzinfo).replace(tzinfo=None)
+
+    # dateparser builds some of its data separately for each set of settings. Parsing
+    # relative to two different times, as the cache does, makes sure all of it is
+    # built
+    for relative_base in (now, now + timedelta(hours=1)):
+        for time_str in WARM_UP_EXPRESSIONS:
+            # Skip the cache, so that its statistics only count real commands
+            _parse(time_str, timezone, False, relative_base, options)
@@ -0,0 +1,111 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from matrix_reminder_bot.config import CONFIG
+from matrix_reminder_bot.errors import WorkerPoolFullError
+
+logger = logging.getLogger(__name__)
+
+
+def _start_worker():
+    """Does nothing, so that submitting it to a process pool starts a worker"""
+
+
+class WorkerPool(object):
+    def __init__(self):
+        """A pool of threads or processes that runs CPU-heavy work off the event loop
+
+        Parsing times and formatting messages can take long enough to hold up syncing
+        and the firing of reminders in every other room. Work is run here instead, and
+        the amount of work that may be waiting for a worker is capped by
+        `workers.max_queued`, so that a flood of commands can't use up all the
+        bot's memory.
+        """
+        self._executor: Optional[Executor] = None
+        # The amount of work that has been submitted but not finished
+        self._pending = 0
+        # A function that each worker process runs as it starts
+        self._initializer: Optional[Callable] = None
+
+    def _get_executor(self) -> Executor:
+        """Create the executor on first use, once the config has been read"""
+        if self._executor is None:
+            if CONFIG.workers.type == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=CONFIG.workers.max_workers,
+                    initializer=self._initializer,
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=CONFIG.workers.max_workers,
+                    thread_name_prefix="worker",
+                )
+            logger.debug(
+                "Started a %s pool with %d workers",
+                CONFIG.workers.type,
+                CONFIG.workers.max_workers,
+            )
+
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a function in the pool and wait for its result
+
+        When using a process pool, the function and its arguments must be picklable.
+
+        Raises:
+            WorkerPoolFullError: if too much work is already waiting to be run
+        """
+        if self._pending >= CONFIG.workers.max_queued:
+            raise WorkerPoolFullError()
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self._get_executor(), functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self._pending -= 1
+
+    async def warm_up(self, func: Callable, *args):
+        """Run a function that loads data the pool's work will need, ahead of the
+        first piece of work
+
+        Threads share the data, so for a thread pool the function is run once. Each
+        process has its own copy, so for a process pool it is run by every worker
+        process as it starts, and all of the workers are started now.
+        """
+        loop = asyncio.get_event_loop()
+        if CONFIG.workers.type != "process":
+            await loop.run_in_executor(
+                self._get_executor(), functools.partial(func, *args)
+            )
+            return
+
+        if self._executor is not None:
+            # Workers that are already running wouldn't run the new initializer, so
+            # start a fresh pool. Work that was sent to the old one still finishes
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+        self._initializer = functools.partial(func, *args)
+        executor = self._get_executor()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(executor, _start_worker)
+                for _ in range(CONFIG.workers.max_workers)
+            )
+        )
+
+    def shutdown(self):
+        """Stop the workers, without waiting for queued work to finish"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+WORKERS = WorkerPool()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""Measures how long reminders take to be delivered when many fire at once
+
+Fills a fresh SQLite database with reminders that are all due at the same moment,
+spread across a number of rooms, then starts the bot against a fake homeserver (see
+fake_homeserver.py) and waits for every reminder to arrive. Reports the delay between
+the reminders' fire time and each one reaching the homeserver.
+
+The bot's outbound rate limit is left off by default, as it is in the bot, so that
+what's measured is how quickly the bot can get reminders out, rather than how quickly
+it's allowed to.
+
+Usage:
+    scripts-dev/benchmark_fire_storm.py [--reminders 10000] [--rooms 1000]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_startup import create_tables, write_config  # noqa: E402
+from fake_homeserver import FakeHomeserver  # noqa: E402
+
+
+def create_database(path: str, reminders: int, rooms: int, fire_time: datetime):
+    """Create a bot database of one-off reminders that all fire at fire_time"""
+    create_tables(path)
+
+    next_fire_at = fire_time.strftime("%Y-%m-%dT%H:%M:%S")
+    rows = [
+        (
+            f"reminder number {index}",
+            fire_time.isoformat(),
+            "Etc/UTC",
+            f"!room{index % rooms}:localhost",
+            False,
+            next_fire_at,
+        )
+        for index in range(reminders)
+    ]
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO reminder (
+                text, start_time, timezone, room_id, alarm, next_fire_at
+            ) VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    conn.close()
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args, config_path: str, fire_time: datetime):
+    homeserver = FakeHomeserver(rooms=args.rooms)
+    await homeserver.start(port=args.port)
+
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        os.path.join(REPO_ROOT, "matrix-reminder-bot"),
+        config_path,
+        stdout=None if args.verbose else asyncio.subprocess.DEVNULL,
+        stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+        env=dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(
+                filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])
+            ),
+        ),
+    )
+
+    # The fire time, as time.monotonic() seconds, which is what the homeserver uses
+    fire_timestamp = (
+        fire_time.replace(tzinfo=timezone.utc).timestamp()
+        - time.time()
+        + time.monotonic()
+    )
+
+    try:
+        deadline = fire_timestamp + args.timeout
+        while len(homeserver.sent_events) < args.reminders:
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    f"Timed out with {len(homeserver.sent_events)} of "
+                    f"{args.reminders} reminders delivered"
+                )
+            if process.returncode is not None:
+                raise RuntimeError("The bot exited early")
+            await asyncio.sleep(0.1)
+
+        if not homeserver.sync_times or homeserver.sync_times[0] > fire_timestamp:
+            print("Warning: the bot hadn't synced by the time the reminders fired")
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+            await process.wait()
+        await homeserver.stop()
+
+    delays = [sent_at - fire_timestamp for sent_at, _, _, _ in homeserver.sent_events]
+    print(
+        f"delivered {len(delays)} reminders to {args.rooms} rooms: "
+        f"p50 {statistics.median(delays):.2f}s, "
+        f"p99 {percentile(delays, 0.99):.2f}s, "
+        f"last {max(delays):.2f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--reminders", type=int, default=10000, help="Reminders that fire at once"
+    )
+    parser.add_argument(
+        "--rooms", type=int, default=1000, help="Rooms the reminders are spread over"
+    )
+    parser.add_argument(
+        "--messages-per-second",
+        type=int,
+        default=0,
+        help="The bot's outbound rate limit, or 0 for none",
+    )
+    parser.add_argument(
+        "--max-concurrent-sends",
+        type=int,
+        default=4,
+        help="The bot's limit on messages being sent at once",
+    )
+    parser.add_argument(
+        "--lead-time",
+        type=int,
+        default=20,
+        help="Seconds after starting the bot that the reminders fire",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=600,
+        help="Seconds after the reminders fire to give up waiting for them",
+    )
+    parser.add_argument(
+        "--port", type=int, default=18008, help="Port for the fake homeserver"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's logs")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Give the bot time to start up and sync before the reminders fire
+        fire_time = datetime.utcnow().replace(microsecond=0) + timedelta(
+            seconds=args.lead_time
+        )
+        database_path = os.path.join(directory, "bot.db")
+        print(
+            f"Creating a database with {args.reminders} reminders due at "
+            f"{fire_time}..."
+        )
+        create_database(database_path, args.reminders, args.rooms, fire_time)
+
+        config_path = write_config(
+            directory,
+            database_path,
+            args.port,
+            extra={
+                "outbound": {
+                    "messages_per_second": args.messages_per_second,
+                    "burst": max(args.messages_per_second, 1),
+                    "max_concurrent_sends": args.max_concurrent_sends,
+                }
+            },
+        )
+
+        asyncio.run(run(args, config_path, fire_time))
+
+
+if __name__ == "__main__":
+    main()
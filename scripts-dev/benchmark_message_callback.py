@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Measures how many messages per second Callbacks.message can get through
+
+Feeds a stream of identical messages through the message callback and reports the
+throughput for ordinary chatter, for commands the bot doesn't recognise, and for a
+command that the bot replies to. Replies are queued but never sent, so only the
+bot's own work is measured.
+
+Usage:
+    scripts-dev/benchmark_message_callback.py [--messages 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from nio import MatrixRoom, RoomMessageText
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from matrix_reminder_bot.callbacks import Callbacks  # noqa: E402
+from matrix_reminder_bot.config import CONFIG  # noqa: E402
+from matrix_reminder_bot.workers import WORKERS  # noqa: E402
+
+BOT_USER_ID = "@bot:localhost"
+ROOM_ID = "!room:localhost"
+
+# (name, body, formatted body)
+TRAFFIC = [
+    ("chatter", "Has anyone seen the latest build results?", None),
+    (
+        "formatted chatter",
+        "Has anyone seen the **latest** build results?",
+        "<p>Has anyone seen the <strong>latest</strong> build results?</p>\n",
+    ),
+    ("unknown command", "!notacommand with some arguments", None),
+    ("help command", "!help", None),
+]
+
+
+class FakeClient(object):
+    """Just enough of a nio client for the bot to handle messages"""
+
+    user = BOT_USER_ID
+
+
+def make_event(body: str, formatted_body: str = None) -> RoomMessageText:
+    source = {
+        "event_id": "$event:localhost",
+        "sender": "@someone:localhost",
+        "origin_server_ts": 0,
+        "type": "m.room.message",
+        "content": {"msgtype": "m.text", "body": body},
+    }
+    if formatted_body is not None:
+        source["content"]["format"] = "org.matrix.custom.html"
+        source["content"]["formatted_body"] = formatted_body
+    return RoomMessageText.from_dict(source)
+
+
+async def messages_per_second(
+    callbacks: Callbacks, room: MatrixRoom, event: RoomMessageText, messages: int
+) -> float:
+    start = time.perf_counter()
+    for _ in range(messages):
+        await callbacks.message(room, event)
+    return messages / (time.perf_counter() - start)
+
+
+async def run(messages: int):
+    callbacks = Callbacks(FakeClient(), None)
+    room = MatrixRoom(ROOM_ID, BOT_USER_ID)
+
+    print(f"{'traffic':<20} {'messages/sec':>14}")
+    for name, body, formatted_body in TRAFFIC:
+        event = make_event(body, formatted_body)
+
+        # Get any lazy imports and caches out of the way before timing anything
+        await messages_per_second(callbacks, room, event, 10)
+
+        rate = await messages_per_second(callbacks, room, event, messages)
+        print(f"{name:<20} {rate:>14.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--messages", type=int, default=20000, help="Messages of each kind to send"
+    )
+    args = parser.parse_args()
+
+    # The defaults from sample.config.yaml
+    CONFIG.command_prefix = "!"
+    CONFIG.workers.type = "thread"
+    CONFIG.workers.max_workers = 2
+    CONFIG.workers.max_queued = 100
+
+    try:
+        asyncio.run(run(args.messages))
+    finally:
+        WORKERS.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Reports how many bytes of memory each scheduled Reminder takes up
+
+Creates and schedules a number of one-off, interval and cron reminders, and measures
+the memory allocated for each kind with tracemalloc. Reminder texts are allocated
+before measuring, as they're the same no matter how reminders are represented.
+
+Usage:
+    scripts-dev/benchmark_reminder_memory.py [--count 10000] [--scheduler heap]
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from matrix_reminder_bot.config import CONFIG  # noqa: E402
+from matrix_reminder_bot.reminder import (  # noqa: E402
+    REMINDERS,
+    Reminder,
+    get_scheduler,
+)
+
+
+def make_reminder(kind: str, text: str, index: int) -> Reminder:
+    """Create a reminder of the given kind that fires far in the future"""
+    room_id = f"!room{index % 100}:example.com"
+    start_time = datetime.now() + timedelta(days=30, seconds=index)
+
+    if kind == "one-shot":
+        return Reminder(room_id, text, start_time=start_time, timezone=CONFIG.timezone)
+    if kind == "interval":
+        return Reminder(
+            room_id,
+            text,
+            start_time=start_time,
+            timezone=CONFIG.timezone,
+            recurse_timedelta=timedelta(days=1),
+        )
+    return Reminder(
+        room_id, text, timezone=CONFIG.timezone, cron_tab=f"{index % 60} 9 * * 1-5"
+    )
+
+
+async def measure(kind: str, count: int) -> float:
+    """Returns the average number of bytes allocated per reminder of a given kind"""
+    texts = [f"{kind} reminder number {index}" for index in range(count)]
+
+    gc.collect()
+    tracemalloc.start()
+
+    reminders = []
+    for index, text in enumerate(texts):
+        reminder = make_reminder(kind, text, index)
+        REMINDERS[reminder.key] = reminder
+        reminders.append(reminder)
+
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Clean up before measuring the next kind
+    for reminder in reminders:
+        REMINDERS.pop(reminder.key)
+        reminder._unschedule()
+
+    return memory / count
+
+
+async def run(count: int):
+    get_scheduler().start()
+
+    print(f"{'kind':<10} {'bytes/reminder':>15}")
+    for kind in ("one-shot", "interval", "cron"):
+        print(f"{kind:<10} {await measure(kind, count):>15.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--count", type=int, default=10000, help="Reminders to create of each kind"
+    )
+    parser.add_argument(
+        "--scheduler",
+        default="apscheduler",
+        choices=["apscheduler", "heap"],
+        help="The scheduler engine to use",
+    )
+    args = parser.parse_args()
+
+    CONFIG.timezone = "Europe/London"
+    CONFIG.scheduler = args.scheduler
+
+    asyncio.run(run(args.count))
+
+
+if __name__ == "__main__":
+    main()
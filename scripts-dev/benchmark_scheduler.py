@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Compares the memory use and fire latency of the scheduler engines
+
+For each engine and job count, this schedules that many jobs with a mix of date,
+interval and cron triggers, almost all of which are far in the future. A smaller
+number of jobs are due a few seconds after the scheduler starts. The lateness of each
+of those is recorded once they fire.
+
+Usage:
+    scripts-dev/benchmark_scheduler.py [--counts 10000 100000 1000000] [--due 1000]
+
+Memory is measured with tracemalloc in a separate pass, as tracing slows adding jobs
+down several times over and leaves a stall of around half a second behind once it is
+stopped, which would otherwise show up as lateness. Note that APScheduler's job store
+inserts every job into a sorted list, so adding a million jobs to it takes a very long
+time. Due jobs that APScheduler drops for firing more than a second late are missing
+from the "fired" column.
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytz
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from matrix_reminder_bot.reminder import TimerHeap  # noqa: E402
+
+# How long after starting the scheduler the due jobs should fire
+DUE_DELAY = timedelta(seconds=3)
+
+
+def make_trigger(index: int, now: datetime):
+    """Build one of a mix of far-future date, interval and cron triggers"""
+    kind = index % 3
+    if kind == 0:
+        return DateTrigger(run_date=now + timedelta(days=30, seconds=index))
+    if kind == 1:
+        return IntervalTrigger(
+            weeks=1, start_date=now + timedelta(days=30, seconds=index)
+        )
+    return CronTrigger.from_crontab(
+        f"{index % 60} {index % 24} 1 1 *", timezone=pytz.utc
+    )
+
+
+def make_scheduler(engine: str):
+    if engine == "apscheduler":
+        return AsyncIOScheduler(timezone=pytz.utc)
+    return TimerHeap()
+
+
+def stop_scheduler(scheduler):
+    if isinstance(scheduler, AsyncIOScheduler):
+        scheduler.shutdown(wait=False)
+
+
+async def noop():
+    pass
+
+
+async def measure_memory(engine: str, triggers: list) -> int:
+    """Returns the number of bytes a running scheduler uses for the given jobs"""
+    scheduler = make_scheduler(engine)
+
+    gc.collect()
+    tracemalloc.start()
+
+    for trigger in triggers:
+        scheduler.add_job(noop, trigger=trigger)
+    scheduler.start()
+
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stop_scheduler(scheduler)
+    return memory
+
+
+async def run_benchmark(engine: str, count: int, due: int) -> dict:
+    lateness = []
+    fire_time = datetime.now(tz=pytz.utc)
+
+    async def record():
+        # Record how late this job fired
+        lateness.append(time.time() - fire_time.timestamp())
+
+    # Triggers are the same for both engines, so they're built up front and don't
+    # count towards the time and memory used by the scheduler
+    now = datetime.now(tz=pytz.utc)
+    triggers = [make_trigger(index, now) for index in range(count - due)]
+
+    memory = await measure_memory(engine, triggers)
+
+    scheduler = make_scheduler(engine)
+    gc.collect()
+    started_adding = time.perf_counter()
+
+    for trigger in triggers:
+        scheduler.add_job(noop, trigger=trigger)
+    scheduler.start()
+
+    add_seconds = time.perf_counter() - started_adding
+
+    # The due jobs are scheduled once the scheduler is running, so that the time spent
+    # adding jobs doesn't count towards their lateness
+    fire_time = datetime.now(tz=pytz.utc) + DUE_DELAY
+    for _ in range(due):
+        scheduler.add_job(record, trigger=DateTrigger(run_date=fire_time))
+
+    # Wait for the due jobs to fire
+    deadline = fire_time + DUE_DELAY * 3
+    while len(lateness) < due and datetime.now(tz=pytz.utc) < deadline:
+        await asyncio.sleep(0.1)
+
+    if engine == "apscheduler":
+        # Let the last jobs finish before shutting down
+        await asyncio.sleep(0.5)
+    stop_scheduler(scheduler)
+
+    return {
+        "add_seconds": add_seconds,
+        "bytes_per_job": memory / count,
+        "fired": len(lateness),
+        "p50_ms": statistics.median(lateness) * 1000 if lateness else None,
+        "p99_ms": sorted(lateness)[int(len(lateness) * 0.99) - 1] * 1000
+        if lateness
+        else None,
+    }
+
+
+def main():
+    # Don't print a warning for every job that APScheduler misses
+    logging.getLogger("apscheduler").setLevel(logging.ERROR)
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--counts", nargs="+", type=int, default=[10000, 100000], help="Job counts"
+    )
+    parser.add_argument(
+        "--due", type=int, default=1000, help="Number of jobs that fire during a run"
+    )
+    parser.add_argument(
+        "--engines", nargs="+", default=["apscheduler", "heap"], help="Engines to run"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'engine':<12} {'jobs':>9} {'add (s)':>9} {'bytes/job':>10} "
+        f"{'fired':>7} {'p50 (ms)':>9} {'p99 (ms)':>9}"
+    )
+    for count in args.counts:
+        for engine in args.engines:
+            result = asyncio.run(run_benchmark(engine, count, min(args.due, count)))
+            p50 = f"{result['p50_ms']:.1f}" if result["p50_ms"] is not None else "-"
+            p99 = f"{result['p99_ms']:.1f}" if result["p99_ms"] is not None else "-"
+            print(
+                f"{engine:<12} {count:>9} {result['add_seconds']:>9.2f} "
+                f"{result['bytes_per_job']:>10.0f} {result['fired']:>7} "
+                f"{p50:>9} {p99:>9}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Measures how long the bot takes to start up with a large reminder table
+
+Fills a fresh SQLite database with reminders, then repeatedly starts the bot against
+a fake homeserver (see fake_homeserver.py) and measures the time from starting the
+process to:
+
+* the "Startup complete" log line, and
+* the end of the first sync, taken as when the bot makes its second sync request.
+
+Usage:
+    scripts-dev/benchmark_startup.py [--reminders 100000] [--rooms 100] [--runs 3]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+import yaml
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_homeserver import FakeHomeserver  # noqa: E402
+
+from matrix_reminder_bot.config import CONFIG  # noqa: E402
+from matrix_reminder_bot.storage import Storage  # noqa: E402
+
+# How long to wait for the bot to get through its first sync before giving up
+RUN_TIMEOUT = 300
+
+
+def create_tables(path: str):
+    """Create an empty bot database"""
+    # Let the bot create the tables, so they match the current migration
+    CONFIG.database.type = "sqlite"
+    CONFIG.database.connection_string = path
+    CONFIG.timezone = "Etc/UTC"
+
+    async def set_up():
+        store = Storage(None)
+        await store.setup()
+        await store.close()
+
+    asyncio.run(set_up())
+
+
+def create_database(path: str, reminders: int, rooms: int):
+    """Create a bot database containing a mix of one-off, repeating and cron reminders"""
+    create_tables(path)
+
+    now = datetime.utcnow().replace(microsecond=0)
+    rows = []
+    for index in range(reminders):
+        start_time = now + timedelta(days=1, seconds=index)
+        kind = index % 3
+        rows.append(
+            (
+                f"reminder number {index}",
+                start_time.isoformat() if kind != 2 else None,
+                "Etc/UTC",
+                86400 if kind == 1 else None,
+                f"{index % 60} 9 * * 1-5" if kind == 2 else None,
+                f"!room{index % rooms}:localhost",
+                None,
+                False,
+                start_time.strftime("%Y-%m-%dT%H:%M:%S"),
+            )
+        )
+
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            """
+            INSERT INTO reminder (
+                text,
+                start_time,
+                timezone,
+                recurse_timedelta_s,
+                cron_tab,
+                room_id,
+                target_user,
+                alarm,
+                next_fire_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    conn.close()
+
+
+def write_config(
+    directory: str, database_path: str, port: int, extra: Optional[dict] = None
+) -> str:
+    """Write a bot config file pointing at the fake homeserver, returning its path
+
+    Args:
+        extra: Config sections to add to, or replace in, the config file
+    """
+    config = {
+        "command_prefix": "!",
+        "matrix": {
+            "user_id": "@bot:localhost",
+            "user_password": "password",
+            "homeserver_url": f"http://127.0.0.1:{port}",
+            "device_id": "BENCHMARK",
+            "device_name": "Benchmark",
+        },
+        "storage": {
+            "database": f"sqlite://{database_path}",
+            "store_path": os.path.join(directory, "store"),
+        },
+        "reminders": {"timezone": "Etc/UTC"},
+        "logging": {
+            "level": "INFO",
+            "file_logging": {"enabled": False},
+            "console_logging": {"enabled": True},
+        },
+    }
+    config.update(extra or {})
+
+    config_path = os.path.join(directory, "config.yaml")
+    with open(config_path, "w") as config_file:
+        yaml.safe_dump(config, config_file)
+    return config_path
+
+
+async def run_once(config_path: str, rooms: int, port: int) -> dict:
+    """Start the bot once and time how long it takes to get going"""
+    homeserver = FakeHomeserver(rooms=rooms)
+    await homeserver.start(port=port)
+
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        os.path.join(REPO_ROOT, "matrix-reminder-bot"),
+        config_path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        env=dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(
+                filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])
+            ),
+        ),
+    )
+
+    startup_complete = None
+    output = []
+    try:
+        deadline = started + RUN_TIMEOUT
+        while time.monotonic() < deadline:
+            # The bot makes a second sync request once it has dealt with the first
+            if startup_complete is not None and len(homeserver.sync_times) >= 2:
+                break
+
+            try:
+                line = await asyncio.wait_for(process.stdout.readline(), 0.05)
+            except asyncio.TimeoutError:
+                continue
+            if not line:
+                if process.returncode is not None or process.stdout.at_eof():
+                    raise RuntimeError(
+                        "The bot exited early:\n" + "".join(output[-20:])
+                    )
+                continue
+
+            output.append(line.decode(errors="replace"))
+            if startup_complete is None and b"Startup complete" in line:
+                startup_complete = time.monotonic()
+        else:
+            raise RuntimeError(
+                "Timed out waiting for the bot to sync:\n" + "".join(output[-20:])
+            )
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGTERM)
+            await process.communicate()
+        await homeserver.stop()
+
+    return {
+        "startup_complete": startup_complete - started,
+        "first_sync_done": homeserver.sync_times[1] - started,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--reminders", type=int, default=100000, help="Reminders in the database"
+    )
+    parser.add_argument(
+        "--rooms", type=int, default=100, help="Rooms the bot is joined to"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Times to start the bot")
+    parser.add_argument(
+        "--port", type=int, default=18008, help="Port for the fake homeserver"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = os.path.join(directory, "bot.db")
+        print(f"Creating a database with {args.reminders} reminders...")
+        create_database(database_path, args.reminders, args.rooms)
+        config_path = write_config(directory, database_path, args.port)
+
+        results = []
+        for run in range(args.runs):
+            result = asyncio.run(run_once(config_path, args.rooms, args.port))
+            print(
+                f"run {run + 1}: startup complete {result['startup_complete']:.2f}s, "
+                f"first sync done {result['first_sync_done']:.2f}s"
+            )
+            results.append(result)
+
+    print(
+        f"median: startup complete "
+        f"{statistics.median(r['startup_complete'] for r in results):.2f}s, "
+        f"first sync done "
+        f"{statistics.median(r['first_sync_done'] for r in results):.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
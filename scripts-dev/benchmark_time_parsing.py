@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Compares how long it takes to parse common time expressions
+
+Each expression is parsed repeatedly by dateparser, the time expression cache, and
+parse_time (which tries the fast path first), and the median time per parse is
+reported.
+
+Usage:
+    scripts-dev/benchmark_time_parsing.py [--iterations 200]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import dateparser
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from matrix_reminder_bot.time_parsing import TIME_PARSE_CACHE, parse_time  # noqa: E402
+
+EXPRESSIONS = [
+    "in 10 minutes",
+    "in 2 hours",
+    "1 week",
+    "14:30",
+    "9am",
+    "tomorrow at 9:00",
+    "2030-10-20T10:00:00+02:00",
+    "next monday",
+]
+
+TIMEZONE = "Europe/London"
+
+
+def time_calls(func, iterations: int) -> float:
+    """Returns the median number of microseconds a call to func takes"""
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="Parses of each expression"
+    )
+    args = parser.parse_args()
+
+    settings = {
+        "PREFER_DATES_FROM": "future",
+        "TIMEZONE": TIMEZONE,
+        "RETURN_AS_TIMEZONE_AWARE": True,
+    }
+
+    # Load dateparser's language data before timing anything
+    dateparser.parse("in 1 minute", settings=settings)
+
+    print(
+        f"{'expression':<28} {'dateparser (us)':>16} {'cached (us)':>12} "
+        f"{'parse_time (us)':>16}"
+    )
+    for expression in EXPRESSIONS:
+        uncached = time_calls(
+            lambda: dateparser.parse(expression, settings=settings), args.iterations
+        )
+        TIME_PARSE_CACHE.cache_clear()
+        cached = time_calls(
+            lambda: TIME_PARSE_CACHE.parse(expression, TIMEZONE, True),
+            args.iterations,
+        )
+        fast = time_calls(lambda: parse_time(expression, TIMEZONE), args.iterations)
+        print(f"{expression:<28} {uncached:>16.1f} {cached:>12.1f} {fast:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""Checks that the fast time parser agrees with dateparser
+
+Every expression in the corpus is parsed by both the fast path and dateparser, at a
+number of different times of day and in a number of timezones, and the results are
+compared. The fast path must handle every expression in HANDLED, and must leave every
+expression in UNHANDLED to dateparser. Exits with a non-zero status on any mismatch.
+
+Usage:
+    scripts-dev/check_time_parsing.py [--verbose]
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+import dateparser
+import pytz
+
+# Allow running this script from a checkout without installing the bot
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from matrix_reminder_bot.time_parsing import parse_fast, parse_interval  # noqa: E402
+
+# Expressions relative to the current time
+RELATIVE = [
+    "in 1 second",
+    "in 30 seconds",
+    "in 5 secs",
+    "in 1 minute",
+    "in 10 minutes",
+    "in 01 minutes",
+    "in 5min",
+    "in 5 mins",
+    "in 1 hour",
+    "in 2 hours",
+    "in 3 hrs",
+    "in 1 day",
+    "in 2 days",
+    "in 1 week",
+    "in 3 weeks",
+    "10 minutes",
+    "3 hours",
+    "1 week",
+    "In  10  Minutes",
+]
+
+# Times of day, which mean the next time the clock shows that time
+TIMES_OF_DAY = [
+    "9:00",
+    "09:00",
+    "09:05",
+    "14:30",
+    "23:59:59",
+    "0:30",
+    "9am",
+    "9 am",
+    "9:30pm",
+    "12am",
+    "12pm",
+    "12:30am",
+]
+
+# Times tomorrow
+TOMORROW = [
+    "tomorrow at 9:00",
+    "tomorrow at 09:30",
+    "tomorrow at 9am",
+    "tomorrow at 12am",
+    "tomorrow 17:45",
+    "tomorrow at 6:15pm",
+]
+
+# ISO 8601 timestamps
+ISO_8601 = [
+    "2030-10-20",
+    "2030-10-20 10:00",
+    "2030-10-20T10:00:00",
+    "2030-10-20t10:00:00.5",
+    "2030-10-20T10:00:00Z",
+    "2030-10-20T10:00:00+02:00",
+    "2030-10-20T10:00:00-05:00",
+    "2030-03-31T01:30:00+00:00",
+]
+
+# ISO 8601 timestamps that dateparser fails to parse, but the fast path handles
+ISO_8601_UNSUPPORTED_BY_DATEPARSER = [
+    "2030-10-20T10:00:00-05:30",
+    "2030-10-20T10:00:00-09:30",
+]
+
+HANDLED = RELATIVE + TIMES_OF_DAY + TOMORROW + ISO_8601
+
+# Expressions that must be left to dateparser
+UNHANDLED = [
+    "next monday",
+    "in 1 month",
+    "in an hour",
+    "tomorrow",
+    "9",
+    "24:00",
+    "9:60",
+    "13pm",
+    "0am",
+    "tomorrow at 13pm",
+    "in 10000000 days",
+    "2030-13-01",
+    "2030-10-20T10:00:00+0200",
+    "december 25",
+]
+
+INTERVALS = ["1 second", "30 minutes", "1 hour", "2 days", "1 week", "3 weeks", "5min"]
+
+TIMEZONES = ["Etc/UTC", "Europe/London", "America/New_York", "Asia/Kolkata"]
+
+# Times of day to parse at, chosen to fall either side of the times in the corpus
+BASE_TIMES = [
+    (0, 0, 0, 0),
+    (0, 38, 12, 123456),
+    (8, 59, 0, 0),
+    (9, 0, 0, 0),
+    (9, 0, 0, 500000),
+    (9, 1, 0, 0),
+    (14, 29, 59, 0),
+    (15, 0, 0, 0),
+    (23, 59, 59, 999999),
+]
+
+# Dates to parse at, including either side of DST changes in most timezones
+BASE_DATES = [
+    datetime(2030, 1, 15),
+    datetime(2030, 3, 30),
+    datetime(2030, 10, 26),
+    datetime(2030, 12, 31),
+]
+
+
+def dateparser_parse(
+    time_str: str, timezone: str, tz_aware: bool, now: datetime
+) -> datetime:
+    """Parses a time string the way the bot did before the fast path existed"""
+    return dateparser.parse(
+        time_str,
+        settings={
+            "PREFER_DATES_FROM": "future",
+            "TIMEZONE": timezone,
+            "RETURN_AS_TIMEZONE_AWARE": tz_aware,
+            "RELATIVE_BASE": now,
+        },
+    )
+
+
+def dateparser_is_wrong(time_str: str, timezone: str, now: datetime) -> bool:
+    """Whether dateparser is known to get the day wrong for a time of day
+
+    dateparser compares times of day to the current time after converting them to
+    UTC, so outside of UTC it picks the wrong day for part of each day. On the last
+    day of a month it also moves times that have passed to the next month, rather than
+    the next day. The fast path gets both right, so these aren't compared.
+    """
+    if time_str not in TIMES_OF_DAY:
+        return False
+    return timezone != "Etc/UTC" or (now + timedelta(days=1)).day == 1
+
+
+def check(verbose: bool) -> int:
+    failures = 0
+    comparisons = 0
+
+    for timezone in TIMEZONES:
+        tzinfo = pytz.timezone(timezone)
+        for base_date in BASE_DATES:
+            for hour, minute, second, microsecond in BASE_TIMES:
+                now = base_date.replace(
+                    hour=hour, minute=minute, second=second, microsecond=microsecond
+                )
+                aware_now = tzinfo.localize(now)
+                for tz_aware in (True, False):
+                    for time_str in HANDLED:
+                        if dateparser_is_wrong(time_str, timezone, now):
+                            continue
+
+                        comparisons += 1
+                        fast = parse_fast(time_str, tzinfo, tz_aware, aware_now)
+                        expected = dateparser_parse(time_str, timezone, tz_aware, now)
+                        if fast is None or fast != expected:
+                            failures += 1
+                            print(
+                                f"MISMATCH {time_str!r} in {timezone} at {now} "
+                                f"(tz_aware={tz_aware}): fast path {fast}, "
+                                f"dateparser {expected}"
+                            )
+                        elif verbose:
+                            print(f"ok {time_str!r} in {timezone} at {now}: {fast}")
+
+                    for time_str in ISO_8601_UNSUPPORTED_BY_DATEPARSER:
+                        comparisons += 1
+                        fast = parse_fast(time_str, tzinfo, tz_aware, aware_now)
+                        expected = datetime.fromisoformat(time_str).astimezone(tzinfo)
+                        if not tz_aware:
+                            expected = expected.replace(tzinfo=None)
+                        if fast != expected:
+                            failures += 1
+                            print(
+                                f"MISMATCH {time_str!r} in {timezone}: fast path "
+                                f"{fast}, expected {expected}"
+                            )
+
+                    for time_str in UNHANDLED:
+                        comparisons += 1
+                        fast = parse_fast(time_str, tzinfo, tz_aware, aware_now)
+                        if fast is not None:
+                            failures += 1
+                            print(f"UNEXPECTED {time_str!r} was parsed as {fast}")
+
+    # Intervals used to be worked out by parsing them as a time in the future and
+    # subtracting the current time
+    now = datetime(2030, 1, 15, 12)
+    for time_str in INTERVALS:
+        comparisons += 1
+        interval = parse_interval(time_str)
+        expected = dateparser_parse(time_str, "Etc/UTC", False, now) - now
+        if interval != expected:
+            failures += 1
+            print(f"MISMATCH interval {time_str!r}: {interval}, expected {expected}")
+
+    if parse_interval("0 minutes") is not None:
+        failures += 1
+        print("UNEXPECTED a zero interval was accepted")
+
+    print(f"{comparisons - failures}/{comparisons} comparisons matched")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--verbose", action="store_true", help="Print every comparison made"
+    )
+    args = parser.parse_args()
+
+    sys.exit(check(args.verbose))
+
+
+if __name__ == "__main__":
+    main()
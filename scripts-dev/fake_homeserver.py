@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""A minimal, in-memory Matrix homeserver for benchmarking the bot
+
+Implements just enough of the client-server API for the bot to log in, sync and send
+messages. The bot's account is joined to a number of rooms, but no other users ever
+say anything. Every request is recorded, along with when it arrived, so that
+benchmarks can measure what the bot did and how long it took.
+
+Usage:
+    scripts-dev/fake_homeserver.py [--port 8008] [--rooms 100] [--send-rate-limit 10]
+
+It can also be imported and run inside another script's event loop:
+
+    homeserver = FakeHomeserver(rooms=100)
+    await homeserver.start(port=8008)
+    ...
+    await homeserver.stop()
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+API_PREFIX = "/_matrix/client/v3"
+
+# The longest a sync request is held open for when there's nothing new to return
+MAX_SYNC_WAIT = 1.0
+
+
+class FakeHomeserver(object):
+    def __init__(
+        self,
+        rooms: int = 100,
+        user_id: str = "@bot:localhost",
+        send_rate_limit: Optional[int] = None,
+    ):
+        """
+        Args:
+            rooms: The number of rooms that the bot's account is joined to
+            user_id: The user ID of the bot's account
+            send_rate_limit: If set, the number of events the bot may send each
+                second before being told to slow down with M_LIMIT_EXCEEDED
+        """
+        self.user_id = user_id
+        self.send_rate_limit = send_rate_limit
+        self.room_ids = [f"!room{index}:localhost" for index in range(rooms)]
+
+        # Every request received, as a tuple of (time.monotonic(), method, path)
+        self.requests: List[Tuple[float, str, str]] = []
+        # The times at which sync requests arrived
+        self.sync_times: List[float] = []
+        # Every event sent by the bot, as a tuple of (time.monotonic(), room ID,
+        # event type, content)
+        self.sent_events: List[Tuple[float, str, str, dict]] = []
+        # The number of sends that were rejected for being over the rate limit
+        self.rate_limited = 0
+        # The transaction IDs of events that have been sent, and the event IDs given
+        # to them, so that retried sends don't create duplicate events
+        self._txn_ids: Dict[Tuple[str, str], str] = {}
+        # The start of the current rate limiting window, and the sends made in it
+        self._window_start = 0.0
+        self._window_sends = 0
+
+        self._event_ids = itertools.count()
+        self._runner: Optional[web.AppRunner] = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._record_request])
+        app.router.add_post(API_PREFIX + "/login", self.login)
+        app.router.add_get(API_PREFIX + "/sync", self.sync)
+        app.router.add_post(API_PREFIX + "/user/{user_id}/filter", self.upload_filter)
+        app.router.add_post(API_PREFIX + "/keys/upload", self.keys_upload)
+        app.router.add_post(API_PREFIX + "/keys/query", self.keys_query)
+        app.router.add_post(API_PREFIX + "/keys/claim", self.keys_claim)
+        app.router.add_put(
+            API_PREFIX + "/sendToDevice/{event_type}/{txn_id}", self.send_to_device
+        )
+        app.router.add_get(
+            API_PREFIX + "/rooms/{room_id}/joined_members", self.joined_members
+        )
+        app.router.add_put(
+            API_PREFIX + "/rooms/{room_id}/send/{event_type}/{txn_id}", self.room_send
+        )
+        app.router.add_post(API_PREFIX + "/join/{room_id}", self.join)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8008):
+        """Start serving requests in the background"""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _record_request(self, request: web.Request, handler):
+        self.requests.append((time.monotonic(), request.method, request.path))
+        return await handler(request)
+
+    async def login(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response(
+            {
+                "user_id": self.user_id,
+                "access_token": "fake_access_token",
+                "device_id": body.get("device_id") or "FAKEDEVICE",
+            }
+        )
+
+    async def sync(self, request: web.Request) -> web.Response:
+        self.sync_times.append(time.monotonic())
+
+        since = request.query.get("since")
+        if since is None:
+            # An initial sync returns the state of every joined room
+            rooms = {room_id: self._joined_room(room_id) for room_id in self.room_ids}
+        else:
+            # Nothing ever happens, so hold the request open for a while like a real
+            # homeserver would, then return nothing
+            timeout_ms = int(request.query.get("timeout", 0))
+            await asyncio.sleep(min(timeout_ms / 1000, MAX_SYNC_WAIT))
+            rooms = {}
+
+        return web.json_response(
+            {
+                "next_batch": f"s{len(self.sync_times)}",
+                "rooms": {"join": rooms, "invite": {}, "leave": {}},
+                "to_device": {"events": []},
+                "presence": {"events": []},
+                "account_data": {"events": []},
+                "device_one_time_keys_count": {"signed_curve25519": 50},
+                "device_lists": {"changed": [], "left": []},
+            }
+        )
+
+    def _joined_room(self, room_id: str) -> dict:
+        """The initial sync contents of a room that only the bot is in"""
+        return {
+            "state": {
+                "events": [
+                    self._state_event(
+                        "m.room.create", "", {"creator": self.user_id}, room_id
+                    ),
+                    self._state_event(
+                        "m.room.member",
+                        self.user_id,
+                        {"membership": "join"},
+                        room_id,
+                    ),
+                ]
+            },
+            "timeline": {"events": [], "limited": False, "prev_batch": "p0"},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+            "summary": {"m.joined_member_count": 1, "m.invited_member_count": 0},
+            "unread_notifications": {"highlight_count": 0, "notification_count": 0},
+        }
+
+    def _state_event(
+        self, event_type: str, state_key: str, content: dict, room_id: str
+    ) -> dict:
+        return {
+            "type": event_type,
+            "state_key": state_key,
+            "sender": self.user_id,
+            "content": content,
+            "event_id": f"${next(self._event_ids)}:localhost",
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": room_id,
+        }
+
+    async def upload_filter(self, request: web.Request) -> web.Response:
+        return web.json_response({"filter_id": "1"})
+
+    async def keys_upload(self, request: web.Request) -> web.Response:
+        return web.json_response({"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def keys_query(self, request: web.Request) -> web.Response:
+        return web.json_response({"device_keys": {}, "failures": {}})
+
+    async def keys_claim(self, request: web.Request) -> web.Response:
+        return web.json_response({"one_time_keys": {}, "failures": {}})
+
+    async def send_to_device(self, request: web.Request) -> web.Response:
+        return web.json_response({})
+
+    async def joined_members(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"joined": {self.user_id: {"display_name": None, "avatar_url": None}}}
+        )
+
+    async def room_send(self, request: web.Request) -> web.Response:
+        room_id = request.match_info["room_id"]
+        txn_key = (room_id, request.match_info["txn_id"])
+        if txn_key in self._txn_ids:
+            # A retry of an event that was already sent
+            return web.json_response({"event_id": self._txn_ids[txn_key]})
+
+        if self.send_rate_limit is not None:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._window_sends = 0
+            if self._window_sends >= self.send_rate_limit:
+                self.rate_limited += 1
+                retry_after_ms = int((self._window_start + 1 - now) * 1000) + 1
+                return web.json_response(
+                    {
+                        "errcode": "M_LIMIT_EXCEEDED",
+                        "error": "Too Many Requests",
+                        "retry_after_ms": retry_after_ms,
+                    },
+                    status=429,
+                )
+            self._window_sends += 1
+
+        content = await request.json()
+        event_id = f"${next(self._event_ids)}:localhost"
+        self._txn_ids[txn_key] = event_id
+        self.sent_events.append(
+            (time.monotonic(), room_id, request.match_info["event_type"], content)
+        )
+        return web.json_response({"event_id": event_id})
+
+    async def join(self, request: web.Request) -> web.Response:
+        return web.json_response({"room_id": request.match_info["room_id"]})
+
+
+async def serve(port: int, rooms: int, send_rate_limit: Optional[int]):
+    homeserver = FakeHomeserver(rooms=rooms, send_rate_limit=send_rate_limit)
+    await homeserver.start(port=port)
+    print(f"Fake homeserver listening on http://127.0.0.1:{port}")
+
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(
+                json.dumps(
+                    {
+                        "requests": len(homeserver.requests),
+                        "syncs": len(homeserver.sync_times),
+                        "sent_events": len(homeserver.sent_events),
+                        "rate_limited": homeserver.rate_limited,
+                    }
+                )
+            )
+    finally:
+        await homeserver.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8008, help="Port to listen on")
+    parser.add_argument(
+        "--rooms", type=int, default=100, help="Rooms the bot is joined to"
+    )
+    parser.add_argument(
+        "--send-rate-limit",
+        type=int,
+        help="Events the bot may send each second before being rate limited",
+    )
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.port, args.rooms, args.send_rate_limit))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()